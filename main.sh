@@ -147,34 +147,12 @@ done
 mkdir -p "${OUTPUT}/bd_calculations"
 RESULT_CSV="${OUTPUT}/bd_calculations/results.csv"
 
-echo "Encoder, Commit, Preset, Video, Size, Quality, Bitrate, First Encode Time, Second Encode Time, Decode Time, VMAF, SSIMULACRA2" > "${RESULT_CSV}"
-
-for ENCODER in "${ENCODERS[@]}"; do
-    LASTHASH=$(find "${OUTPUT}/${ENCODER}" -mindepth 1 -maxdepth 1 -type d -printf "%T@ %f\n" | sort -nr | awk 'NR==1{ print $2 }')
-    find "${OUTPUT}/${ENCODER}/${LASTHASH}/" -name '*.stats' -exec awk '{print $0}' {} + >> "${RESULT_CSV}"
-done
-
-echo "Uploading results"
-${CONTAINER_SYSTEM} run --rm -it -v "${OUTPUT}:/${OUTPUT}:z" -v "${SCRIPT_DIR}:/app:z" bd_calculations scripts/upload_metrics.py --input "${RESULT_CSV}" --type "results"
-
-echo "Generating All BD Features"
 OUTDIR=$(dirname "${RESULT_CSV}")
-for ENCODER in "${ENCODERS[@]}"; do
-    LASTHASH=$(find "${OUTPUT}/${ENCODER}" -mindepth 1 -maxdepth 1 -type d -printf "%T@ %f\n" | sort -nr | awk 'NR==1{ print $2 }')
-    PRESETS=$(find "${OUTPUT}/${ENCODER}/${LASTHASH}/" -mindepth 2 -maxdepth 2 -type d -printf "%f\n" | sort -n)
-    for PRESET in ${PRESETS}; do
-        ${CONTAINER_SYSTEM} run --rm -it -v "${OUTPUT}:/${OUTPUT}:z" -v "${SCRIPT_DIR}:/app:z" bd_calculations scripts/bd_features.py --input "${RESULT_CSV}" --output "${OUTDIR}/${ENCODER}_${PRESET}_bd_rates.csv" --encoder "${ENCODER}" --commit "${LASTHASH}" --preset "${PRESET}"
-    done
-done
 
-echo "Combining all BD Features"
-# Combine all BD features into one file
-# Get header from first file
-FIRST=$(find "${OUTDIR}" -name "*_bd_rates.csv" -print -quit)
-head -n1 "${FIRST}" > "${OUTDIR}/all_bd_rates.csv"
-for FILE in "${OUTDIR}"/*_bd_rates.csv; do
-    tail -n+2 "${FILE}" >> "${OUTDIR}/all_bd_rates.csv"
-done
+echo "Collecting results, generating all BD Features and uploading them"
+# One process reads the new .stats files into the results csv and uploads them
+# with the BD rates of every preset of the latest commit of each encoder
+${CONTAINER_SYSTEM} run --rm -it -v "${OUTPUT}:/${OUTPUT}:z" -v "${SCRIPT_DIR}:/app:z" bd_calculations scripts/pipeline.py --input "${OUTPUT}" --latest --results-csv "${RESULT_CSV}" --bd-output "${OUTDIR}/all_bd_rates.csv" --cache "${OUTDIR}/bd_cache.json" --ledger "${OUTDIR}/upload_ledger.log" --encoders "${ENCODERS[@]}"
 
-echo "Uploading BD Features"
-${CONTAINER_SYSTEM} run --rm -it -v "${OUTPUT}:/${OUTPUT}:z" -v "${SCRIPT_DIR}:/app:z" bd_calculations scripts/upload_metrics.py --input "${OUTDIR}/all_bd_rates.csv" --type "calculations"
+echo "Storing per frame scores"
+${CONTAINER_SYSTEM} run --rm -it -v "${OUTPUT}:/${OUTPUT}:z" -v "${SCRIPT_DIR}:/app:z" bd_calculations scripts/frame_store.py --store "${OUTDIR}/frames" --build "${OUTPUT}" --encoders "${ENCODERS[@]}"
@@ -22,11 +22,19 @@ data source."""
 
 
 import math
+import hashlib
+import json
 import numpy
 import csv
 import argparse
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import groupby, islice
 from pathlib import Path
 
+import instrument
+
 
 def bdsnr(metric_set1, metric_set2):
     """
@@ -132,8 +140,333 @@ def bdrate(metric_set1, metric_set2):
     return avg_diff
 
 
-def avg(lst):
-    return sum(lst) / len(lst)
+# Cubic fit of a stack of curves, coeffs are ascending powers of
+# (x - center) / scale and lower/upper are the range of x covered by the points.
+RDFit = namedtuple("RDFit", ["coeffs", "center", "scale", "lower", "upper"])
+
+
+def _fit_cubic(x, y):
+    """
+    Least squares cubic fit of y over x for a stack of curves at once.
+
+    x and y have shape (..., n_points), missing points are NaN. Each curve is
+    centered and scaled before fitting so the Vandermonde matrix stays well
+    conditioned. Curves with fewer than 4 distinct x are fitted one by one
+    with numpy.polyfit, the same as bdrate and bdsnr.
+    """
+    mask = numpy.isfinite(x) & numpy.isfinite(y)
+    masked_x = numpy.where(mask, x, numpy.nan)
+    center = numpy.nanmean(masked_x, axis=-1)
+    scale = numpy.nanstd(masked_x, axis=-1)
+    scale = numpy.where(scale > 0, scale, 1.0)
+
+    t = (x - center[..., None]) / scale[..., None]
+    vander = t[..., None] ** numpy.arange(4)
+
+    # Missing points get an all zero row so they drop out of the fit.
+    vander = numpy.where(mask[..., None], vander, 0.0)
+    y = numpy.where(mask, y, 0.0)
+
+    coeffs = numpy.einsum("...ij,...j->...i", numpy.linalg.pinv(vander), y)
+
+    # With fewer than 4 distinct x the fit is not unique and pinv picks a
+    # different cubic than numpy.polyfit, so those curves are fitted by
+    # polyfit itself in unscaled x
+    steps = numpy.diff(numpy.sort(masked_x, axis=-1), axis=-1) > 0
+    distinct = numpy.sum(steps, axis=-1) + mask.any(axis=-1)
+    deficient = mask.any(axis=-1) & (distinct < 4)
+    if deficient.any():
+        center = numpy.where(deficient, 0.0, center)
+        scale = numpy.where(deficient, 1.0, scale)
+        x = numpy.broadcast_to(x, mask.shape)
+        for index in zip(*numpy.nonzero(deficient)):
+            points = mask[index]
+            coeffs[index] = numpy.polyfit(x[index][points], y[index][points], 3)[::-1]
+
+    return RDFit(
+        coeffs,
+        center,
+        scale,
+        numpy.nanmin(masked_x, axis=-1),
+        numpy.nanmax(masked_x, axis=-1),
+    )
+
+
+def _integrate_cubic(fit, lower, upper):
+    """Closed form integral of a fit from _fit_cubic between lower and upper."""
+
+    def antiderivative(x):
+        t = (x - fit.center) / fit.scale
+        c0, c1, c2, c3 = numpy.moveaxis(fit.coeffs, -1, 0)
+        return t * (c0 + t * (c1 / 2 + t * (c2 / 3 + t * c3 / 4)))
+
+    return fit.scale * (antiderivative(upper) - antiderivative(lower))
+
+
+def _bd_fitted(fit1, fit2):
+    """Average difference of fit2 over fit1 across their overlapping range."""
+    # Integration interval.
+    min_int = numpy.maximum(fit1.lower, fit2.lower)
+    max_int = numpy.minimum(fit1.upper, fit2.upper)
+
+    integrate = _integrate_piecewise if isinstance(fit1, PiecewiseFit) else _integrate_cubic
+    int1 = integrate(fit1, min_int, max_int)
+    int2 = integrate(fit2, min_int, max_int)
+    width = max_int - min_int
+
+    # Piecewise fits end at their outer points, so curves that do not overlap
+    # have no BD rate rather than a difference of 0
+    if integrate is _integrate_piecewise:
+        width = numpy.where(width > 0, width, numpy.nan)
+
+    return int2 - int1, width
+
+
+# Piecewise cubic interpolation of a stack of curves, knots are the sorted x of
+# the points followed by NaN padding and coeffs has shape (..., n_points - 1, 4)
+# with the ascending powers of x - knot of every segment.
+PiecewiseFit = namedtuple("PiecewiseFit", ["knots", "coeffs", "lower", "upper"])
+
+interpolations = ["poly", "pchip", "akima"]
+
+
+def _at(values, index):
+    """values[..., index] with a different index for every curve."""
+    index = numpy.clip(index, 0, values.shape[-1] - 1)
+    return numpy.take_along_axis(values, index[..., None], axis=-1)[..., 0]
+
+
+def _pchip_edge(h0, h1, m0, m1):
+    """One sided three point derivative at the end of a curve, kept monotone."""
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        d = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+
+    opposite = numpy.sign(d) != numpy.sign(m0)
+    overshoot = (numpy.sign(m0) != numpy.sign(m1)) & (numpy.abs(d) > 3 * numpy.abs(m0))
+
+    d = numpy.where(overshoot & ~opposite, 3 * m0, d)
+    return numpy.where(opposite, 0.0, d)
+
+
+def _pchip_derivatives(h, delta, count):
+    """Fritsch-Carlson derivatives at every point, as in SciPy PchipInterpolator."""
+    # Weighted harmonic mean of the neighbouring slopes, zero at extrema
+    h0, h1 = h[..., :-1], h[..., 1:]
+    m0, m1 = delta[..., :-1], delta[..., 1:]
+    w1 = 2 * h1 + h0
+    w2 = h1 + 2 * h0
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        interior = (w1 + w2) / (w1 / m0 + w2 / m1)
+
+    d = numpy.zeros(h.shape[:-1] + (h.shape[-1] + 1,))
+    d[..., 1:-1] = numpy.where(m0 * m1 > 0, interior, 0.0)
+
+    d[..., 0] = _pchip_edge(h[..., 0], h[..., 1], delta[..., 0], delta[..., 1])
+    last = _pchip_edge(
+        _at(h, count - 2), _at(h, count - 3), _at(delta, count - 2), _at(delta, count - 3)
+    )
+    numpy.put_along_axis(d, numpy.maximum(count - 1, 0)[..., None], last[..., None], axis=-1)
+
+    return d
+
+
+def _akima_derivatives(h, delta, count):
+    """Akima derivatives at every point, as in SciPy Akima1DInterpolator."""
+    n_points = h.shape[-1] + 1
+
+    # Two extrapolated slopes on each side of every curve
+    slopes = numpy.zeros(h.shape[:-1] + (n_points + 3,))
+    slopes[..., 2 : n_points + 1] = delta
+    slopes[..., 1] = 2 * slopes[..., 2] - slopes[..., 3]
+    slopes[..., 0] = 2 * slopes[..., 1] - slopes[..., 2]
+
+    end = numpy.maximum(count, 2)[..., None]
+    right = 2 * _at(slopes, end[..., 0]) - _at(slopes, end[..., 0] - 1)
+    numpy.put_along_axis(slopes, end + 1, right[..., None], axis=-1)
+    outer = 2 * right - _at(slopes, end[..., 0])
+    numpy.put_along_axis(slopes, end + 2, outer[..., None], axis=-1)
+
+    d = 0.5 * (slopes[..., 3:] + slopes[..., :-3])
+
+    change = numpy.abs(numpy.diff(slopes, axis=-1))
+    f1 = change[..., 2:]
+    f2 = change[..., :-2]
+    f12 = f1 + f2
+
+    valid = numpy.arange(n_points) < count[..., None]
+    largest = numpy.where(valid, f12, 0.0).max(axis=-1, keepdims=True)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        weighted = (f1 * slopes[..., 1:-2] + f2 * slopes[..., 2:-1]) / f12
+
+    return numpy.where(f12 > 1e-9 * largest, weighted, d)
+
+
+def _fit_piecewise(x, y, interp):
+    """
+    Piecewise cubic Hermite interpolation of y over x for a stack of curves at
+    once, with the derivatives of interp.
+
+    x and y have shape (..., n_points), missing points are NaN. Points do not
+    have to be sorted.
+    """
+    mask = numpy.isfinite(x) & numpy.isfinite(y)
+    count = mask.sum(axis=-1)
+
+    # Sort the points of every curve, missing points last
+    order = numpy.argsort(numpy.where(mask, x, numpy.inf), axis=-1, kind="stable")
+    valid = numpy.arange(x.shape[-1]) < count[..., None]
+    x = numpy.where(valid, numpy.take_along_axis(x, order, axis=-1), numpy.nan)
+    y = numpy.where(valid, numpy.take_along_axis(y, order, axis=-1), numpy.nan)
+
+    # Missing and zero width segments get a flat slope
+    h = numpy.diff(x, axis=-1)
+    segment = valid[..., 1:] & (h > 0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        delta = numpy.where(segment, numpy.diff(y, axis=-1) / h, 0.0)
+    h = numpy.where(segment, h, 0.0)
+
+    # Pad so the derivatives can look two segments ahead on short curves
+    pad = [(0, 0)] * (h.ndim - 1) + [(0, 2)]
+    h_padded = numpy.pad(h, pad)
+    delta_padded = numpy.pad(delta, pad)
+
+    if interp == "pchip":
+        d = _pchip_derivatives(h_padded, delta_padded, count)
+    elif interp == "akima":
+        d = _akima_derivatives(h_padded, delta_padded, count)
+    else:
+        raise ValueError(f"Unknown interpolation {interp}")
+    d = d[..., : x.shape[-1]]
+
+    # Two points are joined by a straight line
+    d = numpy.where((count == 2)[..., None], delta[..., :1], d)
+
+    width = numpy.where(segment, h, 1.0)
+    c2 = (3 * delta - 2 * d[..., :-1] - d[..., 1:]) / width
+    c3 = (d[..., :-1] + d[..., 1:] - 2 * delta) / width**2
+    coeffs = numpy.stack([y[..., :-1], d[..., :-1], c2, c3], axis=-1)
+    coeffs = numpy.where(segment[..., None], coeffs, 0.0)
+
+    return PiecewiseFit(x, coeffs, x[..., 0], _at(x, count - 1))
+
+
+def _integrate_piecewise(fit, lower, upper):
+    """Closed form integral of a fit from _fit_piecewise between lower and upper."""
+    start = fit.knots[..., :-1]
+    end = fit.knots[..., 1:]
+
+    def antiderivative(x):
+        # Part of every segment below x
+        t = numpy.clip(x[..., None], start, end) - start
+        c0, c1, c2, c3 = numpy.moveaxis(fit.coeffs, -1, 0)
+        return t * (c0 + t * (c1 / 2 + t * (c2 / 3 + t * c3 / 4)))
+
+    segments = antiderivative(upper) - antiderivative(lower)
+    return numpy.where(numpy.isfinite(segments), segments, 0.0).sum(axis=-1)
+
+
+def _fit_curves(x, y, interp="poly"):
+    if interp == "poly":
+        return _fit_cubic(x, y)
+    return _fit_piecewise(x, y, interp)
+
+
+def take_fit(fit, indices):
+    """Select curves from a stacked fit along the curve axis."""
+    return type(fit)(*[numpy.take(x, indices, axis=1) for x in fit])
+
+
+def grow_fit(fit, size, capacity):
+    """Copy of the first size curves of a stacked fit with room for capacity curves."""
+    grown = type(fit)(
+        *[numpy.empty(x.shape[:1] + (capacity,) + x.shape[2:], dtype=x.dtype) for x in fit]
+    )
+    for old, new in zip(fit, grown):
+        new[:, :size] = old[:, :size]
+    return grown
+
+
+def fit_quality_curves(rates, metrics, interp="poly"):
+    """
+    Fit metric over log rate, the orientation used by bdsnr.
+
+    rates - bitrates with shape (n_curves, n_points)
+    metrics - metric values with shape (n_metrics, n_curves, n_points)
+    interp - one of interpolations, poly is the global cubic fit of bdsnr
+    """
+    log_rate = numpy.broadcast_to(numpy.log(rates), numpy.shape(metrics))
+    return _fit_curves(log_rate, metrics, interp)
+
+
+def fit_rate_curves(rates, metrics, interp="poly"):
+    """
+    Fit log rate over metric, the orientation used by bdrate.
+
+    rates - bitrates with shape (n_curves, n_points)
+    metrics - metric values with shape (n_metrics, n_curves, n_points)
+    interp - one of interpolations, poly is the global cubic fit of bdrate
+    """
+    log_rate = numpy.broadcast_to(numpy.log(rates), numpy.shape(metrics))
+    return _fit_curves(metrics, log_rate, interp)
+
+
+def bdsnr_fitted(fit1, fit2):
+    """bdsnr for every pair of curves from fit_quality_curves."""
+    diff, width = _bd_fitted(fit1, fit2)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.where(width != 0, diff / width, 0.0)
+
+
+def bdrate_fitted(fit1, fit2):
+    """bdrate for every pair of curves from fit_rate_curves."""
+    diff, width = _bd_fitted(fit1, fit2)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        avg_exp_diff = diff / width
+
+    # In really bad formed data the exponent can grow too large.
+    # clamp it.
+    avg_exp_diff = numpy.minimum(avg_exp_diff, 200)
+
+    # Convert to a percentage.
+    return (numpy.exp(avg_exp_diff) - 1) * 100
+
+
+def bdsnr_batch(rates1, metrics1, rates2, metrics2, interp="poly"):
+    """
+    Vectorized bdsnr over many pairs of rate-distortion curves.
+
+    rates1, rates2 - bitrates with shape (n_pairs, n_points)
+    metrics1, metrics2 - metric values with shape (n_metrics, n_pairs, n_points)
+
+    Curves with fewer points are padded with NaN. Returns an array of shape
+    (n_metrics, n_pairs) with the same values bdsnr would give for each pair
+    with the poly interp.
+    """
+    return bdsnr_fitted(
+        fit_quality_curves(rates1, metrics1, interp),
+        fit_quality_curves(rates2, metrics2, interp),
+    )
+
+
+def bdrate_batch(rates1, metrics1, rates2, metrics2, interp="poly"):
+    """
+    Vectorized bdrate over many pairs of rate-distortion curves.
+
+    rates1, rates2 - bitrates with shape (n_pairs, n_points)
+    metrics1, metrics2 - metric values with shape (n_metrics, n_pairs, n_points)
+
+    Curves with fewer points are padded with NaN. Returns an array of shape
+    (n_metrics, n_pairs) with the same values bdrate would give for each pair
+    with the poly interp.
+    """
+    return bdrate_fitted(
+        fit_rate_curves(rates1, metrics1, interp),
+        fit_rate_curves(rates2, metrics2, interp),
+    )
 
 
 numbers = {
@@ -154,177 +487,1456 @@ numbers = {
 }
 
 
-def calculate_metrics(baseline_dataset, dataset, metric_column):
-    baseline = [
-        (float(x[numbers["bitrate"]]), float(x[metric_column]))
-        for x in baseline_dataset
+metric_columns = ["vmaf_mean", "ssimcra2_mean", "vmaf_5th", "ssimcra2_5th"]
+
+# Columns stored as integer codes into Results.names, all others are floats
+categorical_columns = ["encoder", "commit", "preset", "video", "type"]
+
+
+class Results:
+    """
+    Results csv data as typed columns.
+
+    columns maps every name in numbers to a numpy array, categorical columns
+    hold int32 codes into names[column] and all others hold float64 values.
+    """
+
+    def __init__(self, columns, names):
+        self.columns = columns
+        self.names = names
+
+    def __len__(self):
+        return len(self.columns["encoder"])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def name(self, column, code):
+        return self.names[column][code]
+
+
+def _parse_chunk(rows, names, lookups):
+    """Convert a list of csv rows to typed columns, extending names as needed."""
+    instrument.count("rows_parsed", len(rows))
+    fields = list(zip(*rows)) if rows else [()] * len(numbers)
+
+    columns = {}
+    for column, index in numbers.items():
+        if column in categorical_columns:
+            lookup = lookups[column]
+            for value in fields[index]:
+                if value not in lookup:
+                    lookup[value] = len(lookup)
+                    names[column].append(value)
+            columns[column] = numpy.array(
+                [lookup[x] for x in fields[index]], dtype=numpy.int32
+            )
+        else:
+            columns[column] = numpy.array(fields[index], dtype=numpy.float64)
+
+    return columns
+
+
+def iter_results(file, chunk_size=100000):
+    """
+    Read a results csv in chunks of at most chunk_size rows, yielding Results.
+
+    Only one chunk of csv strings is held in memory at a time. All chunks share
+    the same names, so codes are comparable across chunks.
+    """
+    names = {x: [] for x in categorical_columns}
+    lookups = {x: {} for x in categorical_columns}
+
+    with open(file) as csvfile:
+        reader = csv.reader(csvfile, delimiter=",")
+        next(reader)  # Skip headers
+
+        while True:
+            rows = list(islice(reader, chunk_size))
+            if not rows:
+                break
+
+            # Skip blank lines
+            rows = [x for x in rows if x]
+            if rows:
+                yield Results(_parse_chunk(rows, names, lookups), names)
+
+
+def load_results(file, chunk_size=100000):
+    """Read a whole results csv into one Results."""
+    names = {x: [] for x in categorical_columns}
+    chunks = []
+    for chunk in iter_results(file, chunk_size):
+        names = chunk.names
+        chunks.append(chunk.columns)
+
+    if not chunks:
+        return results_from_rows([])
+
+    return Results(
+        {x: numpy.concatenate([y[x] for y in chunks]) for x in numbers}, names
+    )
+
+
+def results_from_rows(rows):
+    """Results of a list of csv rows, with names of their own."""
+    names = {x: [] for x in categorical_columns}
+    lookups = {x: {} for x in categorical_columns}
+    return Results(_parse_chunk(rows, names, lookups), names)
+
+
+def datasets_to_arrays(table, datasets, n_points=None):
+    """
+    Stack the bitrate and metric columns of several datasets, given as row
+    indices into table, into NaN padded arrays of shape (n_datasets, n_points)
+    and (n_metrics, n_datasets, n_points).
+    """
+    lengths = numpy.array([len(x) for x in datasets], dtype=numpy.int64)
+    if n_points is None:
+        n_points = int(lengths.max(initial=0))
+
+    columns = numpy.stack(
+        [table["bitrate"]] + [table[x] for x in metric_columns]
+    )
+    values = numpy.full((len(columns), len(datasets), n_points), numpy.nan)
+
+    if len(datasets):
+        rows = numpy.concatenate([numpy.asarray(x, dtype=numpy.int64) for x in datasets])
+        curve = numpy.repeat(numpy.arange(len(datasets)), lengths)
+        position = numpy.arange(len(rows)) - numpy.repeat(
+            numpy.cumsum(lengths) - lengths, lengths
+        )
+        values[:, curve, position] = columns[:, rows]
+
+    return values[0], values[1:]
+
+
+class CurveFits:
+    """
+    Memoized bdrate fits of every metric column, keyed by the
+    (video, encoder, commit, preset) of the curve in groups.
+
+    A curve is fitted the first time it is requested and reused by every
+    later comparison, so a baseline is fitted once no matter how many targets
+    are compared against it.
+    """
+
+    def __init__(self, table, groups, interp="poly"):
+        self.table = table
+        self.groups = groups
+        self.interp = interp
+        self.index = {}
+        self.fit = None
+        # Pad every curve to the same length so a fit does not depend on
+        # which other curves it was batched with
+        self.n_points = max([len(x) for x in groups.values()], default=0)
+
+    def get(self, keys):
+        """Stacked fits for keys, in the same order as keys."""
+        new_keys = [x for x in dict.fromkeys(keys) if x not in self.index]
+
+        if new_keys:
+            instrument.count("curves_fitted", len(new_keys))
+            new_fit = fit_rate_curves(
+                *datasets_to_arrays(
+                    self.table,
+                    [self.groups.get(x, []) for x in new_keys],
+                    self.n_points,
+                ),
+                self.interp,
+            )
+            size = len(self.index)
+            end = size + len(new_keys)
+
+            # The stacked fits grow by doubling so adding curves a few at a
+            # time does not copy every earlier fit each time
+            if self.fit is None or end > self.fit[0].shape[1]:
+                capacity = max(end, 2 * size)
+                self.fit = grow_fit(new_fit if self.fit is None else self.fit, size, capacity)
+
+            for stacked, x in zip(self.fit, new_fit):
+                stacked[:, size:end] = x
+            for key in new_keys:
+                self.index[key] = len(self.index)
+
+        return take_fit(self.fit, [self.index[x] for x in keys])
+
+
+def calculate_metrics(fits, baseline_keys, target_keys):
+    """
+    BD rate of every target curve against its baseline curve for all metric
+    columns.
+
+    Returns an array of shape (n_metrics, n_targets) in metric_columns order.
+    """
+    with instrument.span("fit"):
+        baseline_fit = fits.get(baseline_keys)
+        target_fit = fits.get(target_keys)
+
+    with instrument.span("bd"):
+        return numpy.round(bdrate_fitted(baseline_fit, target_fit), 3)
+
+
+def _calculate_chunk(rates, metrics, baseline_index, target_index, interp):
+    """Worker side of calculate_metrics_parallel for one chunk of curves."""
+    fit = fit_rate_curves(rates, metrics, interp)
+    return numpy.round(
+        bdrate_fitted(take_fit(fit, baseline_index), take_fit(fit, target_index)), 3
+    )
+
+
+def calculate_metrics_parallel(table, groups, baseline_keys, target_keys, jobs, interp="poly", executor=None):
+    """
+    calculate_metrics split by video across a process pool, a new one of jobs
+    processes unless an executor is given.
+
+    Each worker receives the curves of its videos as float arrays together with
+    the index of the baseline and target curve of every comparison, so every
+    curve is still fitted once. Results are put back in comparison order.
+    """
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return calculate_metrics_parallel(
+                table, groups, baseline_keys, target_keys, jobs, interp, executor
+            )
+
+    n_points = max([len(x) for x in groups.values()], default=0)
+
+    chunks = {}
+    for i, (baseline_key, target_key) in enumerate(zip(baseline_keys, target_keys)):
+        chunks.setdefault(target_key[0], []).append(i)
+
+    bd_rates = numpy.empty((len(metric_columns), len(target_keys)))
+
+    futures = []
+    for pairs in chunks.values():
+        curve_keys = list(
+            dict.fromkeys(
+                [baseline_keys[i] for i in pairs] + [target_keys[i] for i in pairs]
+            )
+        )
+        curve_index = {x: i for i, x in enumerate(curve_keys)}
+        instrument.count("curves_fitted", len(curve_keys))
+        rates, metrics = datasets_to_arrays(
+            table, [groups[x] for x in curve_keys], n_points
+        )
+
+        futures.append(
+            executor.submit(
+                _calculate_chunk,
+                rates,
+                metrics,
+                [curve_index[baseline_keys[i]] for i in pairs],
+                [curve_index[target_keys[i]] for i in pairs],
+                interp,
+            )
+        )
+
+    for pairs, future in zip(chunks.values(), futures):
+        bd_rates[:, pairs] = future.result()
+
+    return bd_rates
+
+
+# Metric columns whose per frame scores are kept by frame_store.py, with the
+# percentile of the frames each column is, None for the mean
+bootstrap_columns = {"vmaf_mean": None, "vmaf_5th": 5}
+
+
+def resampled_statistics(scores, counts):
+    """
+    Pool resamples of scores like the metric columns of bootstrap_columns.
+
+    counts has shape (n_resamples, len(scores)) and holds how often each frame
+    was drawn in each resample. Percentiles are read from the cumulative counts
+    over the sorted scores, which gives the same value as numpy.percentile of
+    the resampled frames without materializing them.
+    """
+    n_frames = len(scores)
+    order = numpy.argsort(scores, kind="stable")
+
+    statistics = []
+    for percentile in bootstrap_columns.values():
+        if percentile is None:
+            statistics.append(counts @ scores / n_frames)
+            continue
+
+        position = percentile / 100 * (n_frames - 1)
+        lower = math.floor(position)
+        upper = min(lower + 1, n_frames - 1)
+
+        # Only the sorted frames up to a little past the percentile are
+        # needed, all of them are counted if a resample did not reach it
+        width = min(n_frames, upper + 1 + int(6 * math.sqrt(upper + 1)) + 16)
+        cumulative = numpy.cumsum(counts[:, order[:width]], axis=1)
+        if width < n_frames and (cumulative[:, -1] <= upper).any():
+            cumulative = numpy.cumsum(counts[:, order], axis=1)
+
+        # The k-th smallest resampled frame is the first sorted frame whose
+        # cumulative count is above k
+        low = scores[order[(cumulative <= lower).sum(axis=1)]]
+        high = scores[order[(cumulative <= upper).sum(axis=1)]]
+        statistics.append(low + (high - low) * (position - lower))
+
+    return statistics
+
+
+def bootstrap_metrics(store, frame_keys, n_resamples, rng):
+    """
+    Resample the frames of every point of a set of curves and pool them like
+    the metric columns of bootstrap_columns.
+
+    frame_keys holds the frame store key of every point, shape
+    (n_curves, n_points) with None for padding. Every curve is resampled with
+    the same frame positions so comparisons between encodes of a video stay
+    paired. Returns an array of shape (n_columns, n_curves, n_resamples,
+    n_points) and the indices of the curves that have every point in the
+    store, the other curves are NaN.
+    """
+    n_curves = len(frame_keys)
+    n_points = len(frame_keys[0]) if n_curves else 0
+    metrics = numpy.full(
+        (len(bootstrap_columns), n_curves, n_resamples, n_points), numpy.nan
+    )
+
+    lengths = {
+        x: store.index[x][1] if x in store else 0
+        for curve in frame_keys
+        for x in curve
+        if x is not None
+    }
+    complete = [
+        i
+        for i, curve in enumerate(frame_keys)
+        if any(curve) and all(x is None or lengths[x] > 0 for x in curve)
+    ]
+    n_frames = max(lengths.values(), default=0)
+
+    # Limit the frame counts held in memory for long videos
+    block = max(1, (1 << 22) // max(n_frames, 1))
+
+    for start in range(0, n_resamples, block):
+        stop = min(start + block, n_resamples)
+        draws = rng.random((stop - start, n_frames))
+        rows = numpy.arange(stop - start)[:, None]
+
+        # Encodes of the same length share the counts of each resample
+        counts = {}
+        for i in complete:
+            for j, key in enumerate(frame_keys[i]):
+                if key is None:
+                    continue
+
+                length = lengths[key]
+                if length not in counts:
+                    positions = (draws[:, :length] * length).astype(numpy.int64)
+                    counts[length] = numpy.bincount(
+                        (positions + rows * length).ravel(),
+                        minlength=(stop - start) * length,
+                    ).reshape(stop - start, length).astype(numpy.float64)
+
+                scores = numpy.asarray(store.get(key), dtype=numpy.float64)
+                for k, values in enumerate(resampled_statistics(scores, counts[length])):
+                    metrics[k, i, start:stop, j] = values
+
+    return metrics, complete
+
+
+def _bootstrap_chunk(
+    rates, frame_keys, store_directory, baseline_index, target_index, n_resamples, confidence, seed, interp
+):
+    """
+    Confidence interval of the BD rate of every pair of curves of one video
+    for the bootstrap_columns, shape (n_columns, n_pairs, 2).
+    """
+    # Only needed for confidence intervals
+    import frame_store
+
+    store = frame_store.FrameStore(store_directory)
+    metrics, complete = bootstrap_metrics(
+        store, frame_keys, n_resamples, numpy.random.default_rng(seed)
+    )
+
+    intervals = numpy.full((len(bootstrap_columns), len(baseline_index), 2), numpy.nan)
+    complete_set = set(complete)
+    pairs = [
+        i
+        for i, (x, y) in enumerate(zip(baseline_index, target_index))
+        if x in complete_set and y in complete_set
+    ]
+    if not pairs:
+        return intervals
+
+    # Fit every resample of every complete curve once, resample r of the
+    # c-th complete curve is at c * n_resamples + r
+    n_points = rates.shape[1]
+    fit = fit_rate_curves(
+        numpy.repeat(rates[complete], n_resamples, axis=0),
+        metrics[:, complete].reshape(
+            len(bootstrap_columns), len(complete) * n_resamples, n_points
+        ),
+        interp,
+    )
+    position = {x: i for i, x in enumerate(complete)}
+
+    resamples = numpy.arange(n_resamples)
+    bounds = [(100 - confidence) / 2, 100 - (100 - confidence) / 2]
+
+    # Limit the number of pairs integrated at once
+    step = max(1, 200000 // n_resamples)
+    for start in range(0, len(pairs), step):
+        chunk = pairs[start : start + step]
+        baseline_rows = numpy.array([position[baseline_index[i]] for i in chunk])
+        target_rows = numpy.array([position[target_index[i]] for i in chunk])
+        baseline_rows = (baseline_rows[:, None] * n_resamples + resamples).ravel()
+        target_rows = (target_rows[:, None] * n_resamples + resamples).ravel()
+
+        bd_rates = bdrate_fitted(
+            take_fit(fit, baseline_rows), take_fit(fit, target_rows)
+        ).reshape(len(bootstrap_columns), len(chunk), n_resamples)
+
+        intervals[:, chunk] = numpy.moveaxis(
+            numpy.nanpercentile(bd_rates, bounds, axis=-1), 0, -1
+        )
+
+    return numpy.round(intervals, 3)
+
+
+def bootstrap_intervals(
+    table, groups, store_directory, baseline_keys, target_keys, n_resamples=1000, confidence=95, jobs=1, seed=0, interp="poly"
+):
+    """
+    Bootstrap confidence intervals of the BD rate of every target curve against
+    its baseline curve for the bootstrap_columns, resampling the per frame
+    scores of a frame store.
+
+    Comparisons are split by video, across a process pool with more than one
+    job. Each video gets its own seed so the intervals do not depend on jobs.
+    Returns an array of shape (n_columns, n_targets, 2) of the lower and upper
+    bound, NaN where a curve has no per frame scores.
+    """
+    n_points = max([len(x) for x in groups.values()], default=0)
+
+    chunks = {}
+    for i, target_key in enumerate(target_keys):
+        chunks.setdefault(target_key[0], []).append(i)
+
+    intervals = numpy.full((len(bootstrap_columns), len(target_keys), 2), numpy.nan)
+
+    tasks = []
+    for video, pairs in chunks.items():
+        curve_keys = list(
+            dict.fromkeys(
+                [baseline_keys[i] for i in pairs] + [target_keys[i] for i in pairs]
+            )
+        )
+        curve_index = {x: i for i, x in enumerate(curve_keys)}
+        rates, _ = datasets_to_arrays(table, [groups[x] for x in curve_keys], n_points)
+
+        frame_keys = []
+        for key in curve_keys:
+            _, encoder, commit, preset = key
+            qualities = [table.name("type", x) for x in table["type"][groups[key]]]
+            keys = [(encoder, commit, preset, video, x) for x in qualities]
+            frame_keys.append(keys + [None] * (n_points - len(keys)))
+
+        video_seed = [seed, int(hashlib.sha1(video.encode()).hexdigest()[:8], 16)]
+        tasks.append(
+            (
+                rates,
+                frame_keys,
+                store_directory,
+                [curve_index[baseline_keys[i]] for i in pairs],
+                [curve_index[target_keys[i]] for i in pairs],
+                n_resamples,
+                confidence,
+                video_seed,
+                interp,
+            )
+        )
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_bootstrap_chunk, *zip(*tasks)))
+    else:
+        results = [_bootstrap_chunk(*x) for x in tasks]
+
+    for pairs, result in zip(chunks.values(), results):
+        intervals[:, pairs] = result
+
+    return intervals
+
+
+def add_intervals(table, groups, ls, store_directory, n_resamples=1000, confidence=95, jobs=1, seed=0, interp="poly"):
+    """Append the bootstrap confidence intervals to every output row of compare_baselines."""
+    baseline_keys = [(x[6], x[0], x[1], x[2]) for x in ls]
+    target_keys = [(x[6], x[3], x[4], x[5]) for x in ls]
+
+    instrument.count("bootstrap_comparisons", len(ls))
+    with instrument.span("bootstrap"):
+        intervals = bootstrap_intervals(
+            table, groups, store_directory, baseline_keys, target_keys, n_resamples, confidence, jobs, seed, interp
+        )
+
+    # Missing intervals are left empty
+    intervals = intervals.astype(object)
+    intervals[intervals != intervals] = None
+
+    return [
+        x + tuple(intervals[:, i].ravel().tolist()) for i, x in enumerate(ls)
+    ]
+
+
+group_columns = ["video", "encoder", "commit", "preset"]
+
+
+def group_rows(table):
+    """
+    Index the rows of table by (video, encoder, commit, preset) so every curve
+    can be looked up directly instead of rescanning the data.
+
+    Returns a dictionary of row index arrays, in order of first appearance.
+    """
+    if not len(table):
+        return {}
+
+    codes = numpy.stack([table[x] for x in group_columns], axis=1)
+    _, first, inverse = numpy.unique(
+        codes, axis=0, return_index=True, return_inverse=True
+    )
+    inverse = inverse.reshape(-1)
+
+    order = numpy.argsort(inverse, kind="stable")
+    rows = numpy.split(order, numpy.cumsum(numpy.bincount(inverse))[:-1])
+
+    groups = {}
+    for group in numpy.argsort(first, kind="stable"):
+        key = tuple(
+            table.name(x, y) for x, y in zip(group_columns, codes[first[group]])
+        )
+        groups[key] = rows[group]
+
+    return groups
+
+
+def group_times(table, groups):
+    """Average encode (first + second pass) and decode time of every group."""
+    encode_time = table["first_time"] + table["second_time"]
+    return {
+        key: (float(numpy.mean(encode_time[rows])), float(numpy.mean(table["decode_time"][rows])))
+        for key, rows in groups.items()
+    }
+
+
+def parse_baseline(value):
+    """argparse type for a baseline given as encoder:commit:preset."""
+    baseline = tuple(value.split(":"))
+    if len(baseline) != 3 or not all(baseline):
+        raise argparse.ArgumentTypeError(
+            f"{value} is not in the form encoder:commit:preset"
+        )
+
+    return baseline
+
+
+def read_manifest(file):
+    """Baselines from a csv file with one encoder,commit,preset per line."""
+    with open(file) as csvfile:
+        reader = csv.reader(csvfile, delimiter=",")
+        return [
+            tuple(x.strip() for x in row)
+            for row in reader
+            if row and not row[0].startswith("#")
+        ]
+
+
+def curve_hashes(table, groups, keys):
+    """Content hash of the bitrate and metric points of every curve in keys."""
+    columns = numpy.stack(
+        [table["bitrate"]] + [table[x] for x in metric_columns], axis=1
+    )
+    return {
+        key: hashlib.sha1(columns[groups[key]].tobytes()).hexdigest()
+        for key in dict.fromkeys(keys)
+    }
+
+
+class ResultCache:
+    """
+    BD rates of previous runs stored in a json file, keyed by the content
+    hashes of the baseline and target curve. Each entry also records the
+    baseline and target commit so entries of commits that are no longer in the
+    input can be dropped.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.entries = {}
+        if file.exists():
+            with open(file) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        return self.entries[key]["values"]
+
+    def put(self, key, commits, values):
+        self.entries[key] = {"commits": commits, "values": values}
+
+    def prune(self, commits):
+        """Drop every entry whose baseline or target commit is not in commits."""
+        self.entries = {
+            key: value
+            for key, value in self.entries.items()
+            if all(x in commits for x in value["commits"])
+        }
+
+    def save(self):
+        temp = self.file.with_name(self.file.name + ".tmp")
+        with open(temp, "w") as f:
+            json.dump(self.entries, f)
+        temp.replace(self.file)
+
+
+def latest_baselines(table, groups):
+    """
+    Every preset of the latest commit of every encoder, the latest commit
+    being the last one to appear in the data for that encoder.
+    """
+    encoders, last = numpy.unique(table["encoder"][::-1], return_index=True)
+    latest = {
+        table.name("encoder", x): table.name("commit", table["commit"][len(table) - 1 - y])
+        for x, y in zip(encoders, last)
+    }
+
+    return list(
+        dict.fromkeys(
+            (encoder, commit, preset)
+            for _, encoder, commit, preset in groups
+            if latest[encoder] == commit
+        )
+    )
+
+
+def compare_baselines(table, groups, baselines, fits=None, jobs=1, cache=None, interp="poly", targets=None, executor=None):
+    """
+    Compare every curve in groups, or only the keys of groups in targets,
+    against each (encoder, commit, preset) baseline of the same video and
+    return the output rows.
+
+    With more than one job or an executor the BD rates are computed in a
+    process pool, the executor when given. With a ResultCache only pairs of curves that are not in the cache are computed.
+    interp is one of interpolations and must match the interp of fits.
+    """
+    if fits is None:
+        fits = CurveFits(table, groups, interp)
+
+    times = group_times(table, groups)
+
+    ls = []
+    baseline_keys = []
+    target_keys = []
+
+    for baseline_encoder, baseline_commit, baseline_preset in baselines:
+        for video, encoder, commit, preset in groups if targets is None else targets:
+            # Skip the baseline, there is nothing to compare it against
+            if (encoder, commit, preset) == (
+                baseline_encoder,
+                baseline_commit,
+                baseline_preset,
+            ):
+                continue
+
+            baseline_key = (video, baseline_encoder, baseline_commit, baseline_preset)
+
+            # Nothing to compare against if the baseline has no encodes of this video
+            if baseline_key not in groups:
+                continue
+
+            encode_baseline_time, decode_baseline_time = times[baseline_key]
+            encode_flag_time, decode_flag_time = times[(video, encoder, commit, preset)]
+
+            # Calculate time percentage difference
+            if encode_baseline_time != 0:
+                encode_time_diff = round(
+                    (
+                        (encode_flag_time - encode_baseline_time)
+                        / encode_baseline_time
+                        * 100
+                    ),
+                    2,
+                )
+            else:
+                encode_time_diff = 0
+
+            if decode_baseline_time != 0:
+                decode_time_diff = round(
+                    (
+                        (decode_flag_time - decode_baseline_time)
+                        / decode_baseline_time
+                        * 100
+                    ),
+                    2,
+                )
+            else:
+                decode_time_diff = 0
+
+            ls.append(
+                (
+                    baseline_encoder,
+                    baseline_commit,
+                    baseline_preset,
+                    encoder,
+                    commit,
+                    preset,
+                    video,
+                    encode_time_diff,
+                    decode_time_diff,
+                )
+            )
+            baseline_keys.append(baseline_key)
+            target_keys.append((video, encoder, commit, preset))
+
+    instrument.count("comparisons", len(target_keys))
+    bd_rates = numpy.empty((len(metric_columns), len(target_keys)))
+
+    # Only compare curves whose points are not already in the cache
+    if cache is not None:
+        hashes = curve_hashes(table, groups, baseline_keys + target_keys)
+        # Keys of the original polyfit are kept so existing caches stay valid
+        prefix = "" if interp == "poly" else f"{interp}:"
+        pair_keys = [
+            prefix + hashes[x] + hashes[y] for x, y in zip(baseline_keys, target_keys)
+        ]
+        missing = [i for i, x in enumerate(pair_keys) if x not in cache]
+        for i, x in enumerate(pair_keys):
+            if x in cache:
+                bd_rates[:, i] = cache.get(x)
+        instrument.count("cache_hits", len(target_keys) - len(missing))
+        instrument.count("cache_misses", len(missing))
+    else:
+        missing = list(range(len(target_keys)))
+
+    missing_baselines = [baseline_keys[i] for i in missing]
+    missing_targets = [target_keys[i] for i in missing]
+
+    # Compute every BD rate in one batch, one column per metric
+    if (jobs > 1 or executor is not None) and missing:
+        with instrument.span("parallel"):
+            bd_rates[:, missing] = calculate_metrics_parallel(
+                table, groups, missing_baselines, missing_targets, jobs, interp, executor
+            )
+    elif missing:
+        bd_rates[:, missing] = calculate_metrics(fits, missing_baselines, missing_targets)
+
+    if cache is not None:
+        for i in missing:
+            cache.put(
+                pair_keys[i],
+                [baseline_keys[i][2], target_keys[i][2]],
+                bd_rates[:, i].tolist(),
+            )
+
+    ls = [x + tuple(bd_rates[:, i].tolist()) for i, x in enumerate(ls)]
+
+    ls.sort(key=lambda x: x[1])
+    return ls
+
+
+output_header = [
+    "Baseline Encoder",
+    "Baseline Commit",
+    "Baseline Preset",
+    "Target Encoder",
+    "Target Commit",
+    "Target Preset",
+    "Video",
+    "Encode Time Diff Pct",
+    "Decode Time Diff Pct",
+    "VMAF Mean",
+    "SSIMCRA2 Mean",
+    "VMAF 5th",
+    "SSIMCRA2 5th",
+]
+
+
+# Columns added by add_intervals
+interval_header = [
+    f"{x} {y}"
+    for x in ["VMAF Mean", "VMAF 5th"]
+    for y in ["Low", "High"]
+]
+
+
+def write_output(file, ls, header=output_header):
+    with open(file, "w") as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=",")
+        csvwriter.writerow(header)
+        for x in ls:
+            csvwriter.writerow(x)
+
+
+def pareto_frontier(sets, times, values):
+    """
+    Whether each point is on the Pareto frontier of its set, where no other
+    point of the set has both a lower or equal time and a lower or equal
+    value. sets holds an integer code per point.
+
+    One sort by set, time and value and a running minimum over the sorted
+    values, points with a nan value are never on the frontier.
+    """
+    sets = numpy.asarray(sets, dtype=numpy.int64)
+    times = numpy.asarray(times, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    n = len(values)
+
+    # Values are ranked so every set can be offset below all earlier sets,
+    # which restarts the running minimum at each set without losing precision
+    valid = ~numpy.isnan(values)
+    ranks = numpy.full(n, n, dtype=numpy.int64)
+    ranks[valid] = numpy.unique(values[valid], return_inverse=True)[1].reshape(-1)
+
+    order = numpy.lexsort((ranks, times, sets))
+    keyed = ranks[order] - sets[order] * (n + 1)
+    best = numpy.minimum.accumulate(keyed)
+
+    # A point is on the frontier when its value beats every faster point
+    improves = numpy.ones(n, dtype=bool)
+    improves[1:] = keyed[1:] < best[:-1]
+
+    frontier = numpy.empty(n, dtype=bool)
+    frontier[order] = improves & valid[order]
+    return frontier
+
+
+frontier_header = [
+    "Reference Encoder",
+    "Reference Commit",
+    "Reference Preset",
+    "Encoder",
+    "Commit",
+    "Preset",
+    "Video",
+    "Encode Time",
+    "VMAF Mean",
+    "SSIMCRA2 Mean",
+    "VMAF 5th",
+    "SSIMCRA2 5th",
+]
+
+# Video of the rows aggregated over every video
+frontier_all = "all"
+
+
+def compare_frontier(table, groups, reference, metric="vmaf_mean", jobs=1, interp="poly"):
+    """
+    BD rate of every curve against the reference preset of the same video in
+    one batch, and the presets of every encoder and commit that are on the
+    frontier of encode time against the BD rate of metric.
+
+    Returns the frontier rows of every video, followed by the frontier of the
+    encode time and BD rate averaged over the videos every preset of the
+    commit was encoded with.
+    """
+    keys = [x for x in groups if (x[0],) + tuple(reference) in groups]
+    baseline_keys = [(x[0],) + tuple(reference) for x in keys]
+
+    if jobs > 1 and keys:
+        bd_rates = calculate_metrics_parallel(table, groups, baseline_keys, keys, jobs, interp)
+    else:
+        bd_rates = calculate_metrics(CurveFits(table, groups, interp), baseline_keys, keys)
+    instrument.count("comparisons", len(keys))
+
+    times = group_times(table, groups)
+    encode_times = numpy.array([times[x][0] for x in keys])
+    values = bd_rates[metric_columns.index(metric)]
+
+    with instrument.span("frontier"):
+        # Presets are only compared within their video, encoder and commit
+        sets = {}
+        codes = [sets.setdefault(x[:3], len(sets)) for x in keys]
+        frontier = pareto_frontier(codes, encode_times, values)
+
+        # Averages over the videos every preset of the commit has
+        videos = {}
+        for i, (video, encoder, commit, preset) in enumerate(keys):
+            videos.setdefault((encoder, commit), {}).setdefault(preset, {})[video] = i
+
+        averaged = []
+        for (encoder, commit), presets in videos.items():
+            shared = set.intersection(*[set(x) for x in presets.values()])
+            for preset, indices in presets.items():
+                rows = [indices[x] for x in sorted(shared)]
+                if rows:
+                    averaged.append(
+                        (
+                            (encoder, commit, preset),
+                            float(numpy.mean(encode_times[rows])),
+                            numpy.mean(bd_rates[:, rows], axis=1),
+                        )
+                    )
+
+        sets = {}
+        average_frontier = pareto_frontier(
+            [sets.setdefault(x[0][:2], len(sets)) for x in averaged],
+            [x[1] for x in averaged],
+            [x[2][metric_columns.index(metric)] for x in averaged],
+        )
+
+    ls = [
+        tuple(reference)
+        + key[1:]
+        + (key[0], round(float(encode_times[i]), 2))
+        + tuple(bd_rates[:, i].tolist())
+        for i, key in enumerate(keys)
+        if frontier[i]
+    ]
+    ls.sort(key=lambda x: (x[6], x[3], x[4], x[7]))
+
+    ls.extend(
+        sorted(
+            [
+                tuple(reference)
+                + key
+                + (frontier_all, round(encode_time, 2))
+                + tuple(numpy.round(mean_rates, 3).tolist())
+                for (key, encode_time, mean_rates), on_frontier in zip(averaged, average_frontier)
+                if on_frontier
+            ],
+            key=lambda x: (x[3], x[4], x[7]),
+        )
+    )
+
+    return ls
+
+
+def parse_shard(value):
+    """argparse type for a shard given as i/N, i counting from 0."""
+    index, _, count = value.partition("/")
+    try:
+        index, count = int(index), int(count)
+    except ValueError:
+        index, count = -1, 0
+
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not in the form i/N with 0 <= i < N"
+        )
+
+    return index, count
+
+
+def shard_of(values, count):
+    """Shard of a comparison, from a hash that is the same on every machine."""
+    key = "\0".join(values).encode()
+    return int(hashlib.sha1(key).hexdigest()[:8], 16) % count
+
+
+def shard_targets(groups, index, count, by_video=False):
+    """
+    Keys of groups compared in shard index of count, split by video and target
+    commit or, with by_video, by video alone.
+    """
+    return [
+        key
+        for key in groups
+        if shard_of(key[:1] if by_video else key[:3:2], count) == index
     ]
-    target = [(float(x[numbers["bitrate"]]), float(x[metric_column])) for x in dataset]
-    return round(bdrate(baseline, target), 3)
 
 
-def baseline_check(row, args):
-    return (row[numbers["encoder"]] == args.encoder) and (
-        row[numbers["commit"]] == args.commit
-        and (row[numbers["preset"]] == args.preset)
+def file_hash(file):
+    h = hashlib.sha1()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_partial(file, shard, run, header, ls, order):
+    """
+    Write the rows of one shard as json together with the shard, the settings
+    of the run and the position of every row in an unsharded run.
+    """
+    partial = {
+        "shard": shard[0],
+        "shards": shard[1],
+        "run": run,
+        "header": header,
+        "rows": [list(x) + list(y) for x, y in zip(order, ls)],
+    }
+
+    temp = file.with_name(file.name + ".tmp")
+    with open(temp, "w") as f:
+        json.dump(partial, f)
+    temp.replace(file)
+
+
+def merge_partials(files):
+    """
+    Combine the partial outputs of every shard of one run into the header and
+    rows of the unsharded run. Raises ValueError when the partials are from
+    different runs or a shard is missing or given twice.
+    """
+    partials = []
+    for file in files:
+        with open(file) as f:
+            partials.append(json.load(f))
+
+    if not partials:
+        raise ValueError("no partial outputs given")
+
+    first = partials[0]
+    for file, partial in zip(files, partials):
+        for x in ["shards", "run", "header"]:
+            if partial[x] != first[x]:
+                raise ValueError(f"{file} is from a different run, its {x} does not match {files[0]}")
+
+    seen = {}
+    for file, partial in zip(files, partials):
+        if partial["shard"] in seen:
+            raise ValueError(f"shard {partial['shard']} is in both {seen[partial['shard']]} and {file}")
+        seen[partial["shard"]] = file
+
+    missing = sorted(set(range(first["shards"])) - set(seen))
+    if missing:
+        raise ValueError(f"missing shards {', '.join(map(str, missing))} of {first['shards']}")
+
+    # Same order as compare_baselines, by baseline commit and then in the
+    # order the comparisons were made
+    rows = [x for partial in partials for x in partial["rows"]]
+    rows.sort(key=lambda x: (x[3], x[0], x[1]))
+
+    return first["header"], [tuple(x[2:]) for x in rows]
+
+
+# Results columns in the order of numbers, commit, preset and quality are text
+# like in the csv files
+database_query = """
+    SELECT
+        e.name
+        , r.commit::text
+        , r.preset::text
+        , v.name
+        , r.size
+        , r.quality::text
+        , r.bitrate
+        , r.first_encode_time
+        , r.second_encode_time
+        , r.decode_time
+        , r.vmaf
+        , r.ssimulacra2
+        , r.vmaf_5th
+        , r.ssimulacra2_5th
+    FROM results r
+    JOIN encoders_lookup e ON e.id = r.encoder_fkey
+    JOIN videos_lookup v ON v.id = r.video_fkey
+    WHERE {window}
+    ORDER BY v.name, e.name, r.commit, r.preset
+"""
+
+
+def database_latest_baselines(cur):
+    """Every preset of the most recently uploaded commit of every encoder."""
+    cur.execute(
+        """
+        SELECT DISTINCT e.name, r.commit::text, r.preset::text
+        FROM results r
+        JOIN encoders_lookup e ON e.id = r.encoder_fkey
+        JOIN (
+            SELECT DISTINCT ON (encoder_fkey) encoder_fkey, commit
+            FROM results
+            ORDER BY encoder_fkey, timestamp DESC
+        ) l ON l.encoder_fkey = r.encoder_fkey AND l.commit = r.commit
+        ORDER BY 1, 2, 3
+        """
+    )
+    return cur.fetchall()
+
+
+def iter_database_videos(conn, baselines, commits=None, since=None, until=None, itersize=10000, videos=1):
+    """
+    Stream the results table through a server side cursor and yield a
+    Results for the given number of videos at a time. Rows are limited to the
+    given commits and upload time window, the commits of the baselines are
+    always included.
+    """
+    window = ["TRUE"]
+    params = []
+    if commits:
+        window.append("r.commit = ANY(%s)")
+        params.append(commits)
+    if since:
+        window.append("r.timestamp >= %s")
+        params.append(since)
+    if until:
+        window.append("r.timestamp < %s")
+        params.append(until)
+
+    query = database_query.format(
+        window=f"({' AND '.join(window)}) OR r.commit = ANY(%s)"
     )
+    params.append([x[1] for x in baselines])
+
+    with conn.cursor(name="bd_features_results") as cur:
+        cur.itersize = itersize
+        cur.execute(query, params)
+
+        batch = groupby(cur, key=lambda x: x[numbers["video"]])
+        while True:
+            with instrument.span("read"):
+                rows = [x for _, video in islice(batch, videos) for x in video]
+            if not rows:
+                break
+            yield results_from_rows(rows)
+
+
+def compare_database(args, baselines, cache=None):
+    """
+    Compare curves read from the results table one video at a time, or one
+    per job with more than one, and write the rows straight to the
+    calculations table, and to args.output if given. All videos share one
+    process pool.
+    """
+    import psycopg
+    import upload_metrics
+
+    commits = set()
+    ls = []
+    with psycopg.connect(upload_metrics.conninfo()) as read_conn, psycopg.connect(
+        upload_metrics.conninfo()
+    ) as write_conn, (
+        ProcessPoolExecutor(max_workers=args.jobs) if args.jobs > 1 else nullcontext()
+    ) as executor:
+        if args.latest:
+            with read_conn.cursor() as cur:
+                baselines = list(
+                    dict.fromkeys(baselines + database_latest_baselines(cur))
+                )
+
+        if not baselines:
+            return None
+
+        with upload_metrics.counted_cursor(write_conn) as cur:
+            indexed = upload_metrics.has_natural_key_index(cur, "calculations")
+
+        for table in iter_database_videos(
+            read_conn, baselines, args.db_commits, args.since, args.until, videos=args.jobs
+        ):
+            commits.update(table.names["commit"])
+
+            groups = group_rows(table)
+            targets = None
+            if args.shard:
+                targets = shard_targets(groups, *args.shard)
+
+            with instrument.span("compare"):
+                rows = compare_baselines(
+                    table,
+                    groups,
+                    baselines,
+                    jobs=args.jobs,
+                    cache=cache,
+                    interp=args.interp,
+                    targets=targets,
+                    executor=executor,
+                )
+            if not rows:
+                continue
+
+            if args.output:
+                # Same order as comparing one video at a time
+                videos = {x: i for i, x in enumerate(table.names["video"])}
+                ls.extend(sorted(rows, key=lambda x: (x[1], videos[x[6]])))
+
+            with instrument.span("upload"), upload_metrics.counted_cursor(write_conn) as cur:
+                rows = [list(x) for x in rows]
+                encoders, videos = upload_metrics.csv_names(rows, "calculations")
+                encoders_lookup = upload_metrics.add_names_to_lookup(cur, encoders, "encoders_lookup")
+                videos_lookup = upload_metrics.add_names_to_lookup(cur, videos, "videos_lookup")
+
+                keys = None
+                if not indexed:
+                    keys = upload_metrics.fetch_keys(cur, rows, "calculations")
+
+                cur.execute("SELECT now()")
+                timestamp = cur.fetchone()[0]
+
+                # Commits the transaction of these videos
+                inserted = upload_metrics.calculations(
+                    cur, write_conn, rows, encoders_lookup, videos_lookup, timestamp, keys
+                )
+                instrument.count("rows_inserted", inserted)
+                instrument.count("rows_skipped", len(rows) - inserted)
+
+    if args.output:
+        ls.sort(key=lambda x: x[1])
+        with instrument.span("write"):
+            write_output(args.output, ls)
+
+    return commits
 
 
 def main():
     parser = argparse.ArgumentParser(description="Process some integers.")
     parser.add_argument("--input", "-i", type=Path, help="Input File")
     parser.add_argument(
-        "--output", "-o", type=Path, default=Path("bd_rates.csv"), help="Output File"
+        "--output",
+        "-o",
+        type=Path,
+        help="Output File (default bd_rates.csv, not written by default with --database)",
+    )
+    parser.add_argument("--encoder", "-e", type=str, help="Baseline Encoder")
+    parser.add_argument("--commit", "-c", type=str, help="Baseline Commit")
+    parser.add_argument("--preset", "-p", type=str, help="Baseline Preset")
+    parser.add_argument(
+        "--baseline",
+        "-b",
+        type=parse_baseline,
+        action="append",
+        default=[],
+        help="Additional baseline as encoder:commit:preset, can be repeated",
+    )
+    parser.add_argument(
+        "--manifest",
+        "-m",
+        type=Path,
+        help="CSV file with one encoder,commit,preset baseline per line",
+    )
+    parser.add_argument(
+        "--latest",
+        action="store_true",
+        help="Use every preset of the latest commit of every encoder as a baseline",
+    )
+    parser.add_argument(
+        "--interp",
+        choices=interpolations,
+        default="poly",
+        help="Curve fit, the global cubic polyfit or piecewise cubic pchip or akima interpolation",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of processes used to calculate BD rates",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        help="JSON file of previously calculated BD rates, only new or changed curves are calculated. With --shard every shard keeps its own file, named like bd_cache_0_of_4.json",
+    )
+    parser.add_argument(
+        "--frames",
+        "-f",
+        type=Path,
+        help="Frame store of frame_store.py with the per frame scores used by --bootstrap",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        help="Add confidence intervals of the VMAF BD rates from this many resamples of the frames",
+    )
+    parser.add_argument(
+        "--confidence",
+        type=float,
+        default=95,
+        help="Confidence level of the bootstrap intervals in percent",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the bootstrap resamples",
     )
     parser.add_argument(
-        "--encoder", "-e", type=str, help="Baseline Encoder", required=True
+        "--frontier",
+        nargs="?",
+        const="vmaf_mean",
+        choices=metric_columns,
+        help="Write the presets of every encoder and commit on the frontier of encode time against BD rate of this metric (default vmaf_mean), with the one baseline as the reference of every video",
     )
     parser.add_argument(
-        "--commit", "-c", type=str, help="Baseline Commit", required=True
+        "--database",
+        "-d",
+        action="store_true",
+        help="Read results from the database and write the BD rates to the calculations table",
     )
     parser.add_argument(
-        "--preset", "-p", type=str, help="Baseline Preset", required=True
+        "--db-commits",
+        nargs="+",
+        help="Only read results of these commits from the database",
+    )
+    parser.add_argument(
+        "--since",
+        type=str,
+        help="Only read results uploaded at or after this timestamp from the database",
+    )
+    parser.add_argument(
+        "--until",
+        type=str,
+        help="Only read results uploaded before this timestamp from the database",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        help="Only compare shard i/N of the curves, split by a hash of the video and target commit (the video alone with --bootstrap), and write a partial output for merge",
+    )
+    instrument.add_arguments(parser)
+
+    subparsers = parser.add_subparsers(dest="command")
+    merge_parser = subparsers.add_parser(
+        "merge", help="Combine the partial outputs of every --shard into one output"
+    )
+    merge_parser.add_argument(
+        "partials", type=Path, nargs="+", help="Partial outputs of every shard"
+    )
+    merge_parser.add_argument(
+        "--output", "-o", type=Path, default=Path("bd_rates.csv"), help="Output File"
     )
 
     args = parser.parse_args()
 
-    with open(args.input) as csvfile:
-        reader = csv.reader(csvfile, delimiter=",")
-        next(reader)  # Skip headers
-        data = list(reader)
+    if args.command == "merge":
+        instrument.start(args, args.output)
+        try:
+            header, ls = merge_partials(args.partials)
+        except ValueError as err:
+            merge_parser.error(str(err))
+        write_output(args.output, ls, header)
+        return
 
-    commits = list(set([x[numbers["commit"]] for x in data]))
+    baseline_args = [args.encoder, args.commit, args.preset]
+    if any(baseline_args) and not all(baseline_args):
+        parser.error("--encoder, --commit and --preset must be given together")
 
-    ls = []
+    baselines = []
+    if all(baseline_args):
+        baselines.append(tuple(baseline_args))
+    baselines.extend(args.baseline)
+    if args.manifest:
+        baselines.extend(read_manifest(args.manifest))
+    baselines = list(dict.fromkeys(baselines))
 
-    videos = list(set([x[numbers["video"]] for x in data]))
+    if not (baselines or args.latest):
+        parser.error(
+            "a baseline is required, use --encoder/--commit/--preset, --baseline, --manifest or --latest"
+        )
 
-    for video in videos:
+    if args.bootstrap and not args.frames:
+        parser.error("--bootstrap requires --frames")
+    if args.bootstrap and args.database:
+        parser.error("--bootstrap is only supported for csv input")
+    if args.frontier and (args.database or args.bootstrap):
+        parser.error("--frontier is only supported for csv input without --bootstrap")
+    if args.frontier and (args.latest or len(baselines) != 1):
+        parser.error("--frontier requires exactly one baseline as the reference")
+    if args.shard and args.frontier:
+        parser.error("--frontier needs every curve and can not be sharded")
+    if args.shard and args.database and args.output:
+        parser.error("--shard with --database uploads its part and can not write --output")
+    if args.shard and args.output and args.output.suffix != ".json" and not args.database:
+        parser.error("--shard writes a partial json output, --output must end in .json")
 
-        baseline_list = [
-            x
-            for x in data
-            if x[numbers["encoder"]] == args.encoder
-            and x[numbers["commit"]] == args.commit
-            and x[numbers["preset"]] == args.preset
-            and x[numbers["video"]] == video
-        ]
+    if args.database:
+        output = args.output or Path("calculations")
+    elif args.frontier:
+        output = args.output or Path("frontier.csv")
+    elif args.shard:
+        output = args.output or Path(f"bd_rates_{args.shard[0]}_of_{args.shard[1]}.json")
+    else:
+        output = args.output or Path("bd_rates.csv")
+    instrument.start(args, output)
 
-        encode_baseline_time = avg(
-            [
-                (float(x[numbers["first_time"]]) + float(x[numbers["second_time"]]))
-                for x in baseline_list
-            ]
-        )
-        decode_baseline_time = avg(
-            [float(x[numbers["decode_time"]]) for x in baseline_list]
+    # Shards run at the same time and would overwrite each other's entries
+    cache_file = args.cache
+    if args.cache and args.shard:
+        cache_file = args.cache.with_name(
+            f"{args.cache.stem}_{args.shard[0]}_of_{args.shard[1]}{args.cache.suffix}"
         )
+    cache = ResultCache(cache_file) if cache_file else None
 
-        for commit in commits:
-            # Get the data for this commit not including if the commit and preset are the same as the baseline
-            dataset = [
-                x
-                for x in data
-                if x[numbers["commit"]] == commit
-                and x[numbers["video"]] == video
-                and not baseline_check(x, args)
-            ]
-
-            dataset_by_preset = []
-
-            # Generate the data for this commit by preset and add it to the dataset by preset
-            for preset in list(set([x[numbers["preset"]] for x in dataset])):
-                dataset_by_preset.append(
-                    [x for x in dataset if x[numbers["preset"]] == preset]
+    if args.database:
+        commits = compare_database(args, baselines, cache)
+        if commits is None:
+            parser.error("no baseline found in the database")
+    else:
+        with instrument.span("load"):
+            table = load_results(args.input)
+        with instrument.span("group"):
+            groups = group_rows(table)
+
+        if args.frontier:
+            with instrument.span("compare"):
+                ls = compare_frontier(
+                    table, groups, baselines[0], args.frontier, args.jobs, args.interp
                 )
+            with instrument.span("write"):
+                write_output(output, ls, frontier_header)
+            return
 
-            for preset_dataset in dataset_by_preset:
-                target_encoder = preset_dataset[0][numbers["encoder"]]
-                target_commit = preset_dataset[0][numbers["commit"]]
-                target_preset = preset_dataset[0][numbers["preset"]]
-
-                vmaf_mean = calculate_metrics(baseline_list, preset_dataset, numbers["vmaf_mean"])
-                ssimcra2_mean = calculate_metrics(baseline_list, preset_dataset, numbers["ssimcra2_mean"])
-                vmaf_5th = calculate_metrics(baseline_list, preset_dataset, numbers["vmaf_5th"])
-                ssimcra2_5th = calculate_metrics(baseline_list, preset_dataset, numbers["ssimcra2_5th"])
-
-                # Calculate time percentage difference
-                if encode_baseline_time != 0:
-                    encode_flag_time = avg(
-                        [
-                            (
-                                float(x[numbers["first_time"]])
-                                + float(x[numbers["second_time"]])
-                            )
-                            for x in preset_dataset
-                        ]
-                    )
-                    encode_time_diff = round(
-                        (
-                            (encode_flag_time - encode_baseline_time)
-                            / encode_baseline_time
-                            * 100
-                        ),
-                        2,
-                    )
-                else:
-                    encode_time_diff = 0
+        if args.latest:
+            baselines = list(dict.fromkeys(baselines + latest_baselines(table, groups)))
 
-                if decode_baseline_time != 0:
-                    decode_flag_time = avg(
-                        [float(x[numbers["decode_time"]]) for x in preset_dataset]
-                    )
-                    decode_time_diff = round(
-                        (
-                            (decode_flag_time - decode_baseline_time)
-                            / decode_baseline_time
-                            * 100
-                        ),
-                        2,
-                    )
-                else:
-                    decode_time_diff = 0
+        # The bootstrap resamples every comparison of a video together, so
+        # its shards are only split by video
+        targets = None
+        if args.shard:
+            targets = shard_targets(groups, *args.shard, by_video=bool(args.bootstrap))
 
-                ls.append(
-                    (
-                        args.encoder,
-                        args.commit,
-                        args.preset,
-                        target_encoder,
-                        target_commit,
-                        target_preset,
-                        video,
-                        encode_time_diff,
-                        decode_time_diff,
-                        vmaf_mean,
-                        ssimcra2_mean,
-                        vmaf_5th,
-                        ssimcra2_5th,
-                    )
-                )
+        with instrument.span("compare"):
+            ls = compare_baselines(
+                table,
+                groups,
+                baselines,
+                jobs=args.jobs,
+                cache=cache,
+                interp=args.interp,
+                targets=targets,
+            )
 
-    ls.sort(key=lambda x: x[1])
-    with open(args.output, "w") as csvfile:
-        csvwriter = csv.writer(csvfile, delimiter=",")
-        csvwriter.writerow(
-            [
-                "Baseline Encoder",
-                "Baseline Commit",
-                "Baseline Preset",
-                "Target Encoder",
-                "Target Commit",
-                "Target Preset",
-                "Video",
-                "Encode Time Diff Pct",
-                "Decode Time Diff Pct",
-                "VMAF Mean",
-                "SSIMCRA2 Mean",
-                "VMAF 5th",
-                "SSIMCRA2 5th",
-            ]
-        )
-        for x in ls:
-            csvwriter.writerow(x)
+        header = output_header
+        if args.bootstrap:
+            ls = add_intervals(
+                table,
+                groups,
+                ls,
+                args.frames,
+                args.bootstrap,
+                args.confidence,
+                args.jobs,
+                args.seed,
+                args.interp,
+            )
+            header = output_header + interval_header
+
+        with instrument.span("write"):
+            if args.shard:
+                run = {
+                    "input": file_hash(args.input),
+                    "baselines": [list(x) for x in baselines],
+                    "interp": args.interp,
+                    "split": "video" if args.bootstrap else "video,commit",
+                    "bootstrap": args.bootstrap,
+                    "confidence": args.confidence,
+                    "seed": args.seed,
+                }
+                baseline_order = {x: i for i, x in enumerate(baselines)}
+                group_order = {x: i for i, x in enumerate(groups)}
+                order = [
+                    (baseline_order[x[:3]], group_order[(x[6],) + x[3:6]])
+                    for x in ls
+                ]
+                write_partial(output, args.shard, run, header, ls, order)
+            else:
+                write_output(output, ls, header)
+        commits = set(table.names["commit"])
+
+    if cache is not None:
+        with instrument.span("cache"):
+            cache.prune(commits)
+            cache.save()
 
 
 if __name__ == "__main__":
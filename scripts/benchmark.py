@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+import os, sys, argparse, csv, json, platform, statistics, subprocess, tempfile, time
+
+import numpy as np
+
+from pathlib import Path
+
+import bd_features
+import collect_stats
+import parse_vmaf
+
+# Encoders, commits, presets, videos and quality points of every scale
+scales = {
+    "small": (2, 3, 3, 3, 4),
+    "medium": (4, 5, 4, 10, 6),
+    "large": (6, 10, 6, 30, 8),
+}
+
+
+def generate_results(file: Path, encoders, commits, presets, videos, qualities, seed=0):
+    """
+    Write a results csv of encoders x commits x presets x videos x qualities
+    rows with realistic rate-distortion curves. Every video has its own
+    complexity, encoders and presets trade efficiency against encode time and
+    later commits drift a little. Rows are written oldest commit first like
+    collect_stats.py. Returns the number of rows.
+    """
+    rng = np.random.default_rng(seed)
+
+    complexity = rng.lognormal(0, 0.5, videos)
+    frames = rng.integers(240, 1440, videos)
+    efficiency = rng.uniform(0.8, 1.2, encoders)
+    speed = rng.uniform(0.5, 2.0, encoders)
+    drift = 1 + np.cumsum(rng.normal(-0.005, 0.01, (encoders, commits)), axis=1)
+    crf = np.linspace(20, 60, qualities).round().astype(int)
+
+    with open(file, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile, delimiter=",", lineterminator="\n")
+        writer.writerow(collect_stats.header)
+
+        for e in range(encoders):
+            for c in range(commits):
+                for p in range(presets):
+                    preset_efficiency = 1 + 0.04 * p
+                    preset_speed = 2.0**-p
+
+                    for v in range(videos):
+                        noise = rng.normal(0, 0.01, qualities)
+                        bitrate = (
+                            20000
+                            * complexity[v]
+                            * np.exp(-0.08 * crf)
+                            * efficiency[e]
+                            * drift[e, c]
+                            * preset_efficiency
+                            * np.exp(noise)
+                        )
+
+                        # Quality rises with the log of the bitrate relative
+                        # to the complexity of the video
+                        x = np.log(bitrate / (300 * complexity[v]))
+                        vmaf = np.clip(100 / (1 + np.exp(-1.3 * x)) + rng.normal(0, 0.3, qualities), 0, 100)
+                        ssimulacra2 = np.clip(0.95 * vmaf - 10 + rng.normal(0, 0.5, qualities), -100, 100)
+                        vmaf_5th = vmaf - (100 - vmaf) * rng.uniform(0.2, 0.4, qualities)
+                        ssimulacra2_5th = ssimulacra2 - (100 - ssimulacra2) * rng.uniform(0.3, 0.5, qualities)
+
+                        duration = frames[v] / 24
+                        size = bitrate * 1000 / 8 * duration
+                        first_time = duration * speed[e] * preset_speed * rng.uniform(0.9, 1.1, qualities)
+                        second_time = first_time * rng.uniform(1.5, 2.5, qualities)
+                        decode_time = duration * 0.05 * rng.uniform(0.9, 1.1, qualities)
+
+                        for q in range(qualities):
+                            writer.writerow(
+                                [
+                                    f"encoder{e}",
+                                    f"commit{e}x{c:04d}",
+                                    p,
+                                    f"video{v}",
+                                    int(size[q]),
+                                    f"crf{crf[q]}",
+                                    round(float(bitrate[q]), 3),
+                                    round(float(first_time[q]), 2),
+                                    round(float(second_time[q]), 2),
+                                    round(float(decode_time[q]), 2),
+                                    round(float(vmaf[q]), 6),
+                                    round(float(ssimulacra2[q]), 6),
+                                    round(float(vmaf_5th[q]), 6),
+                                    round(float(ssimulacra2_5th[q]), 6),
+                                ]
+                            )
+
+    return encoders * commits * presets * videos * qualities
+
+
+def generate_vmaf_log(file: Path, n_frames, seed=0, chunk_size=10000):
+    """
+    Write a libvmaf JSON log of n_frames frames with the same layout as
+    log_fmt=json, streamed in chunks so logs of any length can be made.
+    """
+    rng = np.random.default_rng(seed)
+
+    # Scene changes shift the score, single frames dip below it
+    scores = np.empty(n_frames)
+    motion = np.empty(n_frames)
+    for start in range(0, n_frames, chunk_size):
+        stop = min(start + chunk_size, n_frames)
+        level = rng.uniform(85, 98)
+        scores[start:stop] = np.clip(
+            level + rng.normal(0, 2, stop - start) - rng.exponential(1, stop - start), 0, 100
+        )
+        motion[start:stop] = rng.uniform(0, 20, stop - start)
+
+    with open(file, "w") as f:
+        f.write('{\n  "version": "3.0.0",\n  "fps": 24.00,\n  "frames": [\n')
+        for start in range(0, n_frames, chunk_size):
+            stop = min(start + chunk_size, n_frames)
+            f.write(
+                ",\n".join(
+                    '    {"frameNum": %d, "metrics": {"integer_adm2": %.6f, '
+                    '"integer_motion2": %.6f, "integer_motion": %.6f, '
+                    '"integer_vif_scale0": %.6f, "vmaf": %.6f}}'
+                    % (i, scores[i] / 100, motion[i], motion[i], scores[i] / 110, scores[i])
+                    for i in range(start, stop)
+                )
+            )
+            f.write(",\n" if stop < n_frames else "\n")
+
+        pooled = {
+            "min": scores.min(),
+            "max": scores.max(),
+            "mean": scores.mean(),
+            "harmonic_mean": parse_vmaf.harmonic_mean(scores),
+        }
+        f.write('  ],\n  "pooled_metrics": {\n    "vmaf": {\n')
+        f.write(",\n".join(f'      "{x}": {y:.6f}' for x, y in pooled.items()))
+        f.write('\n    }\n  },\n  "aggregate_metrics": {\n  }\n}\n')
+
+
+def measure(function, repeat, setup=None):
+    """Run function repeat times and return the seconds of every run and the last result."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+
+    return times, result
+
+
+def record(name, scale, params, items, times):
+    best = min(times)
+    return {
+        "name": name,
+        "scale": scale,
+        "params": params,
+        "items": items,
+        "seconds": best,
+        "median_seconds": statistics.median(times),
+        "items_per_second": items / best if best > 0 else None,
+        "repeats": times,
+    }
+
+
+def benchmark_bd(workdir, scale, repeat, jobs):
+    """Time every stage of bd_features.py on a generated results csv."""
+    params = dict(zip(["encoders", "commits", "presets", "videos", "qualities"], scales[scale]))
+    file = workdir / f"results_{scale}.csv"
+    rows = generate_results(file, *scales[scale])
+
+    records = []
+
+    times, table = measure(lambda: bd_features.load_results(file), repeat)
+    records.append(record("bd_load", scale, params, rows, times))
+
+    times, groups = measure(lambda: bd_features.group_rows(table), repeat)
+    records.append(record("bd_group", scale, params, rows, times))
+
+    baselines = bd_features.latest_baselines(table, groups)
+
+    ls = []
+    for interp in bd_features.interpolations:
+        times, ls = measure(
+            lambda: bd_features.compare_baselines(table, groups, baselines, interp=interp),
+            repeat,
+        )
+        records.append(record(f"bd_compare_{interp}", scale, params, len(ls), times))
+
+    if jobs > 1:
+        times, ls = measure(
+            lambda: bd_features.compare_baselines(table, groups, baselines, jobs=jobs),
+            repeat,
+        )
+        records.append(record(f"bd_compare_poly_jobs{jobs}", scale, params, len(ls), times))
+
+    # Original scalar bdrate of one metric on a sample of the comparisons
+    sample = ls[:: max(1, len(ls) // 200)]
+
+    def scalar():
+        for row in sample:
+            baseline = groups[(row[6], row[0], row[1], row[2])]
+            target = groups[(row[6], row[3], row[4], row[5])]
+            bd_features.bdrate(
+                list(zip(table["bitrate"][baseline], table["vmaf_mean"][baseline])),
+                list(zip(table["bitrate"][target], table["vmaf_mean"][target])),
+            )
+
+    times, _ = measure(scalar, repeat)
+    records.append(record("bd_scalar_bdrate", scale, params, len(sample), times))
+
+    bd_features.write_output(workdir / f"bd_rates_{scale}.csv", ls)
+
+    return records
+
+
+def benchmark_vmaf(workdir, n_frames, repeat):
+    """Time streaming a libvmaf log against loading it with json.load."""
+    file = workdir / f"vmaf_{n_frames}.json"
+    generate_vmaf_log(file, n_frames)
+    params = {"frames": n_frames, "bytes": file.stat().st_size}
+
+    def stream():
+        pooled, scores = parse_vmaf.stream_vmaf_json(file)
+        return parse_vmaf.vmaf_statistics(scores, pooled)
+
+    def load():
+        with open(file) as f:
+            data = json.load(f)
+        scores = np.array([x["metrics"]["vmaf"] for x in data["frames"]])
+        return parse_vmaf.vmaf_statistics(scores, data["pooled_metrics"]["vmaf"])
+
+    records = []
+    times, _ = measure(stream, repeat)
+    records.append(record("vmaf_stream", str(n_frames), params, n_frames, times))
+    times, _ = measure(load, repeat)
+    records.append(record("vmaf_json_load", str(n_frames), params, n_frames, times))
+
+    return records
+
+
+# Columns of the tables upload_metrics.py writes to
+benchmark_schema = """
+    CREATE TABLE encoders_lookup (id serial PRIMARY KEY, name text NOT NULL);
+    CREATE TABLE videos_lookup (id serial PRIMARY KEY, name text NOT NULL);
+    CREATE TABLE results (
+        id serial PRIMARY KEY
+        , timestamp timestamptz
+        , encoder_fkey int REFERENCES encoders_lookup(id)
+        , commit text
+        , preset text
+        , video_fkey int REFERENCES videos_lookup(id)
+        , size numeric
+        , quality text
+        , bitrate numeric
+        , first_encode_time numeric
+        , second_encode_time numeric
+        , decode_time numeric
+        , vmaf numeric
+        , ssimulacra2 numeric
+        , vmaf_5th numeric
+        , ssimulacra2_5th numeric
+    );
+    CREATE TABLE calculations (
+        id serial PRIMARY KEY
+        , timestamp timestamptz
+        , baseline_encoder_fkey int REFERENCES encoders_lookup(id)
+        , baseline_encoder_commit text
+        , baseline_encoder_preset text
+        , target_encoder_fkey int REFERENCES encoders_lookup(id)
+        , target_encoder_commit text
+        , target_encoder_preset text
+        , video_fkey int REFERENCES videos_lookup(id)
+        , encode_time_pct numeric
+        , decode_time_pct numeric
+        , vmaf numeric
+        , ssimulacra2 numeric
+        , vmaf_5th numeric
+        , ssimulacra2_5th numeric
+    );
+"""
+
+# upload_file options of every upload mode, indexed modes run after migrate_schema
+upload_modes = {
+    "rows": ({}, False),
+    "prefetch": ({"prefetch": True}, False),
+    "bulk": ({"bulk": True}, False),
+    "rows_indexed": ({}, True),
+    "bulk_indexed": ({"bulk": True}, True),
+}
+
+
+def benchmark_upload(workdir, scale, repeat, dsn):
+    """
+    Time uploading the generated results and BD rates in every upload mode,
+    into empty tables and again when every row is already there. Runs in a
+    throwaway schema of the database at dsn, never the one of .env.
+    """
+    import psycopg
+    import upload_metrics
+
+    params = dict(zip(["encoders", "commits", "presets", "videos", "qualities"], scales[scale]))
+    files = [
+        ("results", workdir / f"results_{scale}.csv"),
+        ("calculations", workdir / f"bd_rates_{scale}.csv"),
+    ]
+    if not files[0][1].exists():
+        generate_results(files[0][1], *scales[scale])
+    if not files[1][1].exists():
+        table = bd_features.load_results(files[0][1])
+        groups = bd_features.group_rows(table)
+        bd_features.write_output(
+            files[1][1],
+            bd_features.compare_baselines(
+                table, groups, bd_features.latest_baselines(table, groups)
+            ),
+        )
+
+    counts = {}
+    for types, file in files:
+        with open(file) as f:
+            counts[types] = sum(1 for _ in f) - 1
+
+    schema = f"bd_benchmark_{os.getpid()}"
+    records = []
+
+    with psycopg.connect(dsn, autocommit=True) as admin:
+        admin.execute(f"CREATE SCHEMA {schema}")
+        try:
+            with psycopg.connect(dsn, options=f"-c search_path={schema}") as conn:
+
+                def reset(indexed):
+                    conn.execute(
+                        "DROP TABLE IF EXISTS results, calculations, encoders_lookup, videos_lookup"
+                    )
+                    conn.execute(benchmark_schema)
+                    conn.commit()
+                    if indexed:
+                        upload_metrics.migrate_schema(conn)
+
+                for mode, (options, indexed) in upload_modes.items():
+                    for types, file in files:
+
+                        def upload():
+                            upload_metrics.upload_file(conn, file, types, **options)
+
+                        times, _ = measure(upload, repeat, setup=lambda: reset(indexed))
+                        records.append(
+                            record(f"upload_{types}_{mode}", scale, params, counts[types], times)
+                        )
+
+                        # Every row is a duplicate the second time
+                        times, _ = measure(upload, repeat)
+                        records.append(
+                            record(
+                                f"upload_{types}_{mode}_duplicates",
+                                scale,
+                                params,
+                                counts[types],
+                                times,
+                            )
+                        )
+        finally:
+            admin.execute(f"DROP SCHEMA {schema} CASCADE")
+
+    return records
+
+
+def metadata():
+    """Where and on what a run happened, so runs can be told apart."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(report, baseline, threshold):
+    """
+    Print the change of every benchmark against a previous report and return
+    the ones that got slower by more than threshold.
+    """
+    previous = {(x["name"], x["scale"]): x for x in baseline["results"]}
+
+    regressions = []
+    for result in report["results"]:
+        old = previous.get((result["name"], result["scale"]))
+        if old is None or not old["seconds"]:
+            continue
+
+        ratio = result["seconds"] / old["seconds"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  REGRESSION"
+            regressions.append(result)
+        print(
+            f"{result['name']:<44} {result['scale']:>8} {old['seconds']:>10.4f}s -> {result['seconds']:>10.4f}s {ratio:>6.2f}x{flag}"
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark bd_features.py, parse_vmaf.py and upload_metrics.py on generated data"
+    )
+    parser.add_argument(
+        "--suite",
+        "-s",
+        nargs="+",
+        choices=["bd", "vmaf", "upload"],
+        default=["bd", "vmaf", "upload"],
+        help="Benchmarks to run, upload is skipped without --dsn",
+    )
+    parser.add_argument(
+        "--scale",
+        nargs="+",
+        choices=list(scales),
+        default=["small", "medium"],
+        help="Sizes of the generated results for the bd and upload benchmarks",
+    )
+    parser.add_argument(
+        "--frames",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+        help="Frame counts of the generated VMAF logs",
+    )
+    parser.add_argument(
+        "--repeat", "-r", type=int, default=3, help="Runs of every benchmark, the fastest is reported"
+    )
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=1, help="Also time the BD rates with this many processes"
+    )
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        help="Folder for the generated files (default a temporary folder)",
+    )
+    parser.add_argument(
+        "--output", "-o", type=Path, default=Path("benchmark.json"), help="JSON report"
+    )
+    parser.add_argument(
+        "--compare", "-c", type=Path, help="Previous JSON report to compare against"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="Slowdown against --compare that counts as a regression",
+    )
+    parser.add_argument(
+        "--dsn",
+        type=str,
+        help="Connection string of a local throwaway Postgres for the upload benchmark, the database of .env is never used",
+    )
+    parser.add_argument(
+        "--generate",
+        type=Path,
+        help="Only write a generated results csv of the first --scale to this file",
+    )
+    args = parser.parse_args()
+
+    if args.generate:
+        rows = generate_results(args.generate, *scales[args.scale[0]])
+        print(f"Wrote {rows} rows to {args.generate}")
+        return
+
+    with tempfile.TemporaryDirectory() as temp:
+        workdir = args.workdir or Path(temp)
+        workdir.mkdir(parents=True, exist_ok=True)
+
+        results = []
+        for scale in args.scale:
+            if "bd" in args.suite:
+                print(f"Benchmarking bd_features.py at {scale} scale")
+                results.extend(benchmark_bd(workdir, scale, args.repeat, args.jobs))
+
+            if "upload" in args.suite:
+                if not args.dsn:
+                    print("Skipping upload benchmark, no --dsn given")
+                else:
+                    print(f"Benchmarking upload_metrics.py at {scale} scale")
+                    results.extend(benchmark_upload(workdir, scale, args.repeat, args.dsn))
+
+        if "vmaf" in args.suite:
+            for n_frames in args.frames:
+                print(f"Benchmarking parse_vmaf.py with {n_frames} frames")
+                results.extend(benchmark_vmaf(workdir, n_frames, args.repeat))
+
+    report = {"metadata": metadata(), "results": results}
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in results:
+        print(f"{result['name']:<44} {result['scale']:>8} {result['seconds']:>10.4f}s")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
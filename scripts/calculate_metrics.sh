@@ -74,8 +74,8 @@ if [ -n "$LOG" ]; then
     printf '%s\n' "$LOG"
 fi
 
-# Parse VMAF from the json file
-python scripts/parse_vmaf.py --input "${FILE}.json" --output "${FILE}.vmaf"
+# Parse VMAF from the json file, the per frame scores are kept for frame_store.py
+python scripts/parse_vmaf.py --input "${FILE}.json" --output "${FILE}.vmaf" --frames "${FILE}.frames"
 
 # Split the output into mean and 5th percentile by comma
 IFS=',' read -r VMAF_MEAN VMAF_5_PERCENTILE < "${FILE}.vmaf"
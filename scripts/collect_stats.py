@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+import os, argparse, csv, json
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+header = [
+    "Encoder",
+    "Commit",
+    "Preset",
+    "Video",
+    "Size",
+    "Quality",
+    "Bitrate",
+    "First Encode Time",
+    "Second Encode Time",
+    "Decode Time",
+    "VMAF Mean",
+    "SSIMULACRA2 Mean",
+    "VMAF 5th",
+    "SSIMULACRA2 5th",
+]
+
+# Encoder, commit, preset, video and quality identify a row
+key_columns = [0, 1, 2, 3, 5]
+
+
+def row_key(row):
+    return tuple(row[x] for x in key_columns)
+
+
+def walk_stats(directory):
+    """Path, modification time and size of every .stats file below directory."""
+    found = []
+    stack = [directory]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".stats"):
+                    stat = entry.stat()
+                    found.append((entry.path, stat.st_mtime_ns, stat.st_size))
+
+    return found
+
+
+def read_stats(file):
+    """
+    The row of a .stats file, or None while calculate_metrics.sh has not added
+    the metric columns yet.
+    """
+    with open(file) as f:
+        row = next(csv.reader(f, delimiter=","), [])
+
+    if len(row) < len(header):
+        return None
+
+    return row[: len(header)]
+
+
+def commit_directories(output, encoders=None):
+    """
+    Every output/<encoder>/<commit> directory of the given encoders, or of
+    every folder but bd_calculations, oldest first like the LASTHASH lookup
+    of main.sh, so the rows of the newest commit of an encoder are always
+    added last.
+    """
+    commits = [
+        commit
+        for encoder in os.scandir(output)
+        if encoder.is_dir()
+        and (encoder.name in encoders if encoders else encoder.name != "bd_calculations")
+        for commit in os.scandir(encoder.path)
+        if commit.is_dir()
+    ]
+    commits.sort(key=lambda x: x.stat().st_mtime)
+
+    return [x.path for x in commits]
+
+
+def collect(output, index, workers=None, encoders=None):
+    """
+    Find .stats files below output, or below the folders of encoders, that
+    are new or changed since they were recorded in index and read them.
+    Returns the rows read and updates index.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        found = [
+            x
+            for files in executor.map(
+                walk_stats, commit_directories(output, encoders)
+            )
+            for x in files
+        ]
+
+        changed = [
+            (path, mtime, size)
+            for path, mtime, size in found
+            if index.get(path) != [mtime, size]
+        ]
+
+        rows = []
+        for (path, mtime, size), row in zip(
+            changed, executor.map(read_stats, [x[0] for x in changed])
+        ):
+            # Incomplete files are read again on the next run
+            if row is None:
+                continue
+
+            index[path] = [mtime, size]
+            rows.append(row)
+
+    return rows
+
+
+def index_file(results, file=None):
+    """The index file given or the default one next to the results csv."""
+    return file or results.with_name(results.name + ".index.json")
+
+
+def load_index(file, results):
+    """
+    The .stats files recorded in the index file as read, none when it or the
+    results csv is missing since then every file has to be read again.
+    """
+    if file.exists() and results.exists():
+        with open(file) as f:
+            return json.load(f)
+    return {}
+
+
+def save_index(file, index):
+    """Write the index, only call once the rows of its files are stored."""
+    temp = file.with_name(file.name + ".tmp")
+    with open(temp, "w") as f:
+        json.dump(index, f)
+    temp.replace(file)
+
+
+def read_results(results):
+    """Every row of the results csv, without the header."""
+    with open(results) as csvfile:
+        reader = csv.reader(csvfile, delimiter=",")
+        next(reader, None)  # Skip headers
+        return [row for row in reader if row]
+
+
+def update_results(results, rows):
+    """
+    Add rows to the results csv, keeping its history. New keys are appended,
+    the file is only rewritten when a row of an existing key changed.
+    """
+    if not rows and results.exists():
+        return 0
+
+    existing = read_results(results) if results.exists() else []
+
+    positions = {row_key(row): i for i, row in enumerate(existing)}
+
+    new = {}
+    rewrite = False
+    for row in rows:
+        key = row_key(row)
+        if key in positions:
+            if existing[positions[key]] != row:
+                existing[positions[key]] = row
+                rewrite = True
+        else:
+            new[key] = row
+
+    if rewrite or not results.exists():
+        temp = results.with_name(results.name + ".tmp")
+        with open(temp, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile, delimiter=",", lineterminator="\n")
+            writer.writerow(header)
+            writer.writerows(existing)
+            writer.writerows(new.values())
+        temp.replace(results)
+    elif new:
+        with open(results, "a", newline="") as csvfile:
+            writer = csv.writer(csvfile, delimiter=",", lineterminator="\n")
+            writer.writerows(new.values())
+
+    return len(new)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect encoder .stats files into a persistent results csv"
+    )
+    parser.add_argument(
+        "--input", "-i", type=Path, required=True, help="Output folder of run.sh"
+    )
+    parser.add_argument(
+        "--output", "-o", type=Path, required=True, help="Results csv to update"
+    )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        help="JSON index of the .stats files already read (default next to the output)",
+    )
+    parser.add_argument(
+        "--workers", "-w", type=int, help="Number of threads used to walk the folders"
+    )
+    parser.add_argument(
+        "--encoders",
+        nargs="+",
+        help="Only read the folders of these encoders (default every folder but bd_calculations)",
+    )
+    args = parser.parse_args()
+
+    file = index_file(args.output, args.index)
+    index = load_index(file, args.output)
+
+    rows = collect(args.input, index, args.workers, args.encoders)
+    added = update_results(args.output, rows)
+    save_index(file, index)
+
+    print(f"Read {len(rows)} new or changed stats files, added {added} rows")
+
+
+if __name__ == "__main__":
+    main()
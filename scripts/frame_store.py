@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+import argparse, csv, json
+
+import numpy as np
+
+from pathlib import Path
+
+import collect_stats
+import parse_vmaf
+
+# Encoder, commit, preset, video and quality identify the scores of an encode
+key_names = ["encoder", "commit", "preset", "video", "quality"]
+
+statistics = ["mean", "harmonic_mean", "min"]
+
+
+class FrameStore:
+    """
+    Per frame VMAF scores of every encode in one float32 file that is memory
+    mapped on read, with a json index of the offset and frame count of each
+    (encoder, commit, preset, video, quality) key.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.data_file = directory / "scores.f32"
+        self.index_file = directory / "index.json"
+        self.index = {}
+        self._scores = None
+
+        if self.index_file.exists():
+            with open(self.index_file) as f:
+                self.index = {
+                    tuple(x[: len(key_names)]): tuple(x[len(key_names) :])
+                    for x in json.load(f)
+                }
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self, **filters):
+        """Keys in the store, limited to the given values of key_names."""
+        positions = [(key_names.index(x), y) for x, y in filters.items()]
+        return [
+            key for key in self.index if all(key[i] == value for i, value in positions)
+        ]
+
+    @property
+    def scores(self):
+        """Every score in the store as one read only memory map."""
+        if self._scores is None:
+            if not self.data_file.exists() or not self.data_file.stat().st_size:
+                return np.empty(0, dtype="<f4")
+            self._scores = np.memmap(self.data_file, dtype="<f4", mode="r")
+        return self._scores
+
+    def get(self, key):
+        offset, count = self.index[key]
+        return self.scores[offset : offset + count]
+
+    def add(self, items):
+        """
+        Append the scores of (key, scores) pairs. A key that is added again
+        points to its new scores, the old ones stay in the data file.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._scores = None
+
+        with open(self.data_file, "ab") as f:
+            offset = f.tell() // 4
+            for key, scores in items:
+                scores = np.asarray(scores, dtype="<f4")
+                f.write(scores.tobytes())
+                self.index[key] = (offset, len(scores))
+                offset += len(scores)
+
+        # Only point to the new scores once they are written
+        temp = self.index_file.with_name(self.index_file.name + ".tmp")
+        with open(temp, "w") as f:
+            json.dump([list(key) + list(value) for key, value in self.index.items()], f)
+        temp.replace(self.index_file)
+
+    def segments(self, keys):
+        """
+        The scores of keys concatenated, with the start and frame count of
+        each key in the concatenation.
+        """
+        offsets = np.array([self.index[x][0] for x in keys], dtype=np.int64)
+        counts = np.array([self.index[x][1] for x in keys], dtype=np.int64)
+        starts = np.cumsum(counts) - counts
+
+        rows = np.repeat(offsets - starts, counts) + np.arange(counts.sum())
+        return self.scores[rows].astype(np.float64), starts, counts
+
+    def percentiles(self, keys, q):
+        """
+        Percentiles q of every key, shape (len(keys), len(q)), with the same
+        linear interpolation as numpy.percentile.
+        """
+        values, starts, counts = self.segments(keys)
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+
+        # Sorting each key in place is much faster than one lexsort over the
+        # key and the score
+        for start, count in zip(starts.tolist(), counts.tolist()):
+            values[start : start + count].sort()
+
+        last = np.maximum(counts - 1, 0)[:, None]
+        position = q[None, :] / 100 * last
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, last)
+        fraction = position - lower
+
+        if not len(values):
+            return np.full((len(keys), len(q)), np.nan)
+
+        low = values[np.minimum(starts[:, None] + lower, len(values) - 1)]
+        high = values[np.minimum(starts[:, None] + upper, len(values) - 1)]
+        result = low + (high - low) * fraction
+        result[counts == 0] = np.nan
+
+        return result
+
+    def pooled(self, keys):
+        """
+        Mean, harmonic mean and minimum of every key, shape (len(keys), 3), in
+        the order of statistics.
+        """
+        values, starts, counts = self.segments(keys)
+        segment = np.repeat(np.arange(len(keys)), counts)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.bincount(segment, values, len(keys)) / counts
+            harmonic_mean = parse_vmaf.harmonic_mean(values, segment, len(keys))
+
+        minimum = np.full(len(keys), np.nan)
+        present = counts > 0
+        if present.any():
+            minimum[present] = np.minimum.reduceat(values, starts[present])
+
+        return np.stack([mean, harmonic_mean, minimum], axis=1)
+
+    def worst_window(self, keys, window):
+        """
+        Lowest mean score over window consecutive frames of every key, the
+        mean of all frames for keys shorter than window.
+        """
+        values, starts, counts = self.segments(keys)
+        window = np.minimum(window, counts)
+        cumulative = np.concatenate([[0.0], np.cumsum(values)])
+
+        # Every window start that stays inside its key
+        windows = np.where(counts > 0, counts - window + 1, 0)
+        first = np.cumsum(windows) - windows
+        begin = np.repeat(starts - first, windows) + np.arange(windows.sum())
+        length = np.repeat(window, windows)
+
+        means = (cumulative[begin + length] - cumulative[begin]) / length
+
+        result = np.full(len(keys), np.nan)
+        present = windows > 0
+        if present.any():
+            result[present] = np.minimum.reduceat(means, first[present])
+
+        return result
+
+
+def find_frames(output, encoders=None):
+    """
+    Key and .frames file of every encode below output, or below the folders of
+    encoders, that has its per frame scores, the key is read from the .stats
+    file next to it.
+    """
+    found = []
+    for directory in collect_stats.commit_directories(output, encoders):
+        for path, _, _ in collect_stats.walk_stats(directory):
+            frames = Path(path).with_suffix(".frames")
+            if not frames.exists():
+                continue
+
+            with open(path) as f:
+                row = next(csv.reader(f, delimiter=","), [])
+            if len(row) > 5:
+                found.append(((row[0], row[1], row[2], row[3], row[5]), frames))
+
+    return found
+
+
+def build(store, output, rebuild=False, encoders=None):
+    """Add the .frames files below output that are not in the store yet."""
+    found = [(key, frames) for key, frames in find_frames(output, encoders) if rebuild or key not in store]
+    store.add((key, parse_vmaf.read_frames(frames)) for key, frames in found)
+
+    return len(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Store per frame VMAF scores and calculate statistics over them"
+    )
+    parser.add_argument(
+        "--store", "-s", type=Path, required=True, help="Folder of the frame store"
+    )
+    parser.add_argument(
+        "--build",
+        "-b",
+        type=Path,
+        help="Add the .frames files of this run.sh output folder to the store",
+    )
+    parser.add_argument(
+        "--encoders",
+        nargs="+",
+        help="Only build from the folders of these encoders (default every folder but bd_calculations)",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Add the .frames files again even when they are already in the store",
+    )
+    parser.add_argument(
+        "--output", "-o", type=Path, help="CSV file of statistics for every encode"
+    )
+    parser.add_argument(
+        "--percentile",
+        "-p",
+        type=float,
+        nargs="+",
+        default=[1, 5, 10],
+        help="Percentiles to calculate",
+    )
+    parser.add_argument(
+        "--window",
+        "-w",
+        type=int,
+        default=24,
+        help="Frames in the worst window, one second at 24 fps by default",
+    )
+    parser.add_argument("--encoder", "-e", type=str, help="Only this encoder")
+    parser.add_argument("--commit", "-c", type=str, help="Only this commit")
+    args = parser.parse_args()
+
+    store = FrameStore(args.store)
+
+    if args.build:
+        added = build(store, args.build, args.rebuild, args.encoders)
+        print(f"Added {added} encodes, {len(store)} in the store")
+
+    if args.output:
+        filters = {
+            x: getattr(args, x) for x in ["encoder", "commit"] if getattr(args, x)
+        }
+        keys = store.keys(**filters)
+
+        percentiles = store.percentiles(keys, args.percentile)
+        pooled = store.pooled(keys)
+        worst = store.worst_window(keys, args.window)
+
+        with open(args.output, "w") as f:
+            writer = csv.writer(f, delimiter=",")
+            writer.writerow(
+                key_names
+                + ["frames"]
+                + statistics
+                + [f"{x:g}th" for x in args.percentile]
+                + [f"worst_{args.window}"]
+            )
+            for i, key in enumerate(keys):
+                writer.writerow(
+                    list(key)
+                    + [store.index[key][1]]
+                    + [float(x) for x in pooled[i]]
+                    + [float(x) for x in percentiles[i]]
+                    + [float(worst[i])]
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import sys, atexit, cProfile, json, threading, time
+
+from pathlib import Path
+
+# Timing spans and counters shared by the scripts. Everything is a no-op until
+# enable is called, so the calls can stay in place when profiling is off.
+
+enabled = False
+
+_lock = threading.Lock()
+_local = threading.local()
+_spans = {}
+_counters = {}
+_start = None
+_profile = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class _Span:
+    """Time one stage, nested spans are named parent/child."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self.name)
+        self.path = "/".join(stack)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        _local.stack.pop()
+
+        with _lock:
+            span = _spans.setdefault(self.path, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += elapsed
+            span[2] = max(span[2], elapsed)
+
+        return False
+
+
+def span(name):
+    """Context manager timing the stage name while profiling is enabled."""
+    if not enabled:
+        return _null_span
+    return _Span(name)
+
+
+def count(name, n=1):
+    """Add n to the counter name while profiling is enabled."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable(cprofile=False):
+    global enabled, _start, _profile
+
+    enabled = True
+    _start = time.perf_counter()
+    if cprofile:
+        _profile = cProfile.Profile()
+        _profile.enable()
+
+
+def report():
+    """Timing report of everything recorded since enable."""
+    return {
+        "argv": sys.argv,
+        "wall_seconds": time.perf_counter() - _start if _start is not None else 0.0,
+        "spans": {
+            name: {"calls": calls, "seconds": seconds, "max_seconds": longest}
+            for name, (calls, seconds, longest) in sorted(_spans.items())
+        },
+        "counters": dict(sorted(_counters.items())),
+    }
+
+
+def write_report(file: Path):
+    """Write the JSON report to file and the cProfile dump, if any, next to it."""
+    if _profile is not None:
+        _profile.disable()
+        _profile.dump_stats(file.with_suffix(".prof"))
+
+    with open(file, "w") as f:
+        json.dump(report(), f, indent=2)
+
+    print(f"Wrote profile to {file}")
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        help="Write a JSON report of stage timings and counters, next to the output unless a file is given",
+    )
+    parser.add_argument(
+        "--cprofile",
+        action="store_true",
+        help="With --profile also write a cProfile dump next to the report",
+    )
+
+
+def start(args, output):
+    """
+    Enable profiling when --profile was given and write the report when the
+    script exits, to the given file or output.profile.json.
+    """
+    if args.profile is None:
+        return
+
+    file = Path(args.profile) if args.profile else Path(f"{output}.profile.json")
+    enable(args.cprofile)
+    atexit.register(write_report, file)
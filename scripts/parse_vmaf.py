@@ -1,42 +1,275 @@
 #!/usr/bin/env python3
-import os, argparse, json
+import sys, argparse, json, csv, glob
 
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import instrument
 
-def parse_vmaf_json(file: Path):
+
+class JSONStream:
+    """
+    Incremental reader for a JSON document, only a small window of the file is
+    held in memory at a time so large libvmaf logs can be walked value by value.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        data = self.f.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos :] + data
+        self.pos = 0
+
+    def peek(self):
+        """Next non whitespace character, empty at the end of the file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos : self.pos + 1]
+            self.fill()
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number cut by the end of the buffer may continue in the
+                # next chunk, so only accept values followed by a delimiter
+                if self.eof or (end < len(self.buf) and self.buf[end] in ",:]} \t\n\r"):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def items(self):
+        """Iterate over the keys of an object, the caller must consume each value."""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("}")
+                return
+
+    def array(self):
+        """Iterate over the values of an array."""
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+
+        while True:
+            yield self.value()
+
+            if self.peek() == ",":
+                self.pos += 1
+            else:
+                self.expect("]")
+                return
+
+
+def stream_vmaf_json(file: Path, metric="vmaf"):
+    """
+    Read a libvmaf JSON log one frame at a time.
+
+    Returns the pooled metrics of metric and a float64 array of the per frame
+    scores, without holding the whole document in memory.
+    """
+    scores = np.empty(1024, dtype=np.float64)
+    count = 0
+    pooled = None
+
+    with open(file, "r") as f:
+        stream = JSONStream(f)
+        for key in stream.items():
+            if key == "frames":
+                for frame in stream.array():
+                    if count == len(scores):
+                        scores = np.resize(scores, len(scores) * 2)
+                    scores[count] = frame["metrics"][metric]
+                    count += 1
+            elif key == "pooled_metrics":
+                pooled = stream.value()[metric]
+            else:
+                stream.value()
+
+    instrument.count("frames_parsed", count)
+    return pooled, scores[:count]
+
+
+def write_frames(file: Path, scores):
+    """Store per frame scores as raw little endian float32, 4 bytes a frame."""
+    scores.astype("<f4").tofile(file)
+
+
+def read_frames(file: Path):
+    return np.fromfile(file, dtype="<f4")
+
+
+def parse_vmaf_json(file: Path, frames: Path = None):
     try:
-        with open(file, "r") as f:
-            data = json.load(f)
+        with instrument.span("parse"):
+            pooled, scores = stream_vmaf_json(file)
 
-        mean = data["pooled_metrics"]["vmaf"]["mean"]
-        frames = data["frames"]
-        scores = [frame["metrics"]["vmaf"] for frame in frames]
-        percentile_5 = np.percentile(scores, 5)
+        with instrument.span("statistics"):
+            mean = pooled["mean"]
+            percentile_5 = np.percentile(scores, 5)
+
+        if frames:
+            with instrument.span("write_frames"):
+                write_frames(frames, scores)
     except Exception as e:
         print(f"Error parsing file {file}: {e}")
-        os.exit(1)
+        sys.exit(1)
 
     return mean, percentile_5
 
 
+statistics_header = ["mean", "harmonic_mean", "min", "1st", "5th", "10th"]
+
+
+def harmonic_mean(scores, segment=None, n_segments=None):
+    """
+    Harmonic mean of scores as libvmaf defines it, shifted by one so scores of
+    0 do not divide by zero. With segment, the harmonic mean of each of
+    n_segments, segment holding the segment of every score.
+    """
+    inverse = 1.0 / (scores + 1.0)
+    if segment is None:
+        return len(scores) / np.sum(inverse) - 1.0
+
+    counts = np.bincount(segment, minlength=n_segments)
+    return counts / np.bincount(segment, inverse, n_segments) - 1.0
+
+
+def vmaf_statistics(scores, pooled=None):
+    """
+    All statistics of statistics_header from one pass over the scores, the
+    mean is taken from the libvmaf pooled metrics when given.
+    """
+    scores = scores.astype(np.float64)
+    percentiles = np.percentile(scores, [1, 5, 10])
+
+    mean = pooled["mean"] if pooled else scores.mean()
+
+    return [mean, harmonic_mean(scores), scores.min(), *percentiles]
+
+
+def _batch_worker(file):
+    try:
+        pooled, scores = stream_vmaf_json(file)
+        return vmaf_statistics(scores, pooled)
+    except Exception as e:
+        print(f"Error parsing file {file}: {e}")
+        return None
+
+
+def find_logs(pattern):
+    """VMAF logs from a directory, searched recursively, or a glob pattern."""
+    path = Path(pattern)
+    if path.is_dir():
+        return sorted(path.rglob("*.json"))
+
+    return sorted(Path(x) for x in glob.glob(pattern, recursive=True))
+
+
+def parse_batch(files, output: Path, jobs=None):
+    """
+    Parse many VMAF logs across a process pool and write one csv row of
+    statistics per file. Returns the number of files that failed to parse.
+    """
+    failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor, open(output, "w") as f:
+        writer = csv.writer(f, delimiter=",")
+        writer.writerow(["file"] + statistics_header)
+
+        for file, statistics in zip(files, executor.map(_batch_worker, files, chunksize=4)):
+            if statistics is None:
+                failed += 1
+                continue
+            writer.writerow([file] + [float(x) for x in statistics])
+
+    instrument.count("files_parsed", len(files) - failed)
+    instrument.count("files_failed", failed)
+    return failed
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Parse VMAF JSON files for mean and 95 percentile values"
     )
     parser.add_argument("--input", "-i", type=Path, help="Input File")
     parser.add_argument("--output", "-o", type=Path, help="Output File")
+    parser.add_argument(
+        "--frames",
+        "-f",
+        type=Path,
+        help="Also keep the per frame scores in this file for frame_store.py",
+    )
+    parser.add_argument(
+        "--batch",
+        "-b",
+        type=str,
+        help="Directory or glob of VMAF JSON files, writes one combined csv to --output",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="Number of processes used in batch mode (default cpu count)",
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
 
+    instrument.start(args, args.output)
+
+    if args.batch:
+        files = find_logs(args.batch)
+        if not files:
+            print(f"No VMAF files found in {args.batch}")
+            return
+
+        with instrument.span("batch"):
+            failed = parse_batch(files, args.output, args.jobs)
+        if failed:
+            sys.exit(1)
+        return
+
     if not args.input.exists():
         print(f"File {args.input} does not exist")
         return
 
-    mean, percentile_5 = parse_vmaf_json(args.input)
+    mean, percentile_5 = parse_vmaf_json(args.input, args.frames)
 
-    with open(args.output, "w") as f:
+    with instrument.span("write"), open(args.output, "w") as f:
         f.write(f"{mean},{percentile_5}")
 
 
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+import sys, argparse, contextlib, multiprocessing, traceback
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+import bd_features
+import collect_stats
+import instrument
+
+
+def process_pool(jobs):
+    """
+    The process pool that calculates the BD rates of the whole run, a null
+    context for a single job. Workers are spawned rather than forked, the
+    upload threads are already running when the pool is first used.
+    """
+    if jobs > 1:
+        return ProcessPoolExecutor(
+            max_workers=jobs, mp_context=multiprocessing.get_context("spawn")
+        )
+    return contextlib.nullcontext()
+
+
+def bd_rates(rows, baselines, latest=False, jobs=1, cache=None, interp="poly", executor=None, history=False):
+    """
+    BD rate rows of the encodes of the latest commit of every encoder in the
+    results rows, or of every commit with history, compared against baselines
+    and, with latest, every preset of the latest commit of every encoder. Rows
+    are the same text the bd_rates csv files hold.
+    """
+    table = bd_features.results_from_rows(rows)
+    groups = bd_features.group_rows(table)
+
+    newest = bd_features.latest_baselines(table, groups)
+    if latest:
+        baselines = list(dict.fromkeys(baselines + newest))
+
+    # The results csv keeps every commit, comparing all of them every night
+    # would grow with the square of the history
+    targets = None
+    if not history:
+        newest = set(newest)
+        targets = [x for x in groups if x[1:] in newest]
+
+    ls = bd_features.compare_baselines(
+        table,
+        groups,
+        baselines,
+        jobs=jobs,
+        cache=cache,
+        interp=interp,
+        targets=targets,
+        executor=executor,
+    )
+    return [[str(x) for x in row] for row in ls]
+
+
+def _upload_batch(pool, rows, types, options):
+    import upload_metrics
+
+    try:
+        with pool.connection() as conn:
+            upload_metrics.upload_rows(conn, rows, types, **options)
+        return True
+    except Exception as err:
+        print(f"Failed to upload {len(rows)} {types} rows: {err=}, {type(err)=}")
+        print(traceback.format_exc())
+        return False
+
+
+def run(args, baselines, index, submit, executor=None):
+    """
+    Read the .stats files that are new or changed since they were recorded in
+    index, calculate the BD rates of the latest commit of every encoder and
+    hand both sets of rows to submit. Returns the results and BD rate rows.
+    """
+    with instrument.span("collect"):
+        rows = collect_stats.collect(args.input, index, args.workers, args.encoders)
+    submit(rows, "results")
+
+    print(f"Read {len(rows)} new or changed stats files")
+
+    # BD rates also compare against the earlier results kept in the csv
+    collected = rows
+    if args.results_csv:
+        with instrument.span("write"):
+            collect_stats.update_results(args.results_csv, rows)
+            collected = collect_stats.read_results(args.results_csv)
+
+    cache = bd_features.ResultCache(args.cache) if args.cache else None
+
+    with instrument.span("compare"):
+        ls = bd_rates(
+            collected,
+            baselines,
+            args.latest,
+            args.jobs,
+            cache,
+            args.interp,
+            executor,
+            args.history,
+        )
+    submit(ls, "calculations")
+
+    print(f"Calculated {len(ls)} BD rates")
+
+    if cache is not None:
+        cache.prune({x[1] for x in collected})
+        cache.save()
+
+    return collected, ls
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Collect results, calculate BD rates and upload both in one process"
+    )
+    parser.add_argument(
+        "--input", "-i", type=Path, required=True, help="Output folder of run.sh"
+    )
+    parser.add_argument(
+        "--encoders",
+        nargs="+",
+        help="Only read the folders of these encoders (default every folder but bd_calculations)",
+    )
+    parser.add_argument(
+        "--results-csv",
+        type=Path,
+        help="Results csv the new results are added to, it keeps the earlier commits to compare against",
+    )
+    parser.add_argument(
+        "--index",
+        type=Path,
+        help="JSON index of the .stats files already read (default next to the results csv)",
+    )
+    parser.add_argument(
+        "--bd-output",
+        type=Path,
+        help="Also write the BD rates to this csv",
+    )
+    parser.add_argument(
+        "--baseline",
+        "-b",
+        type=bd_features.parse_baseline,
+        action="append",
+        default=[],
+        help="Baseline as encoder:commit:preset, can be repeated",
+    )
+    parser.add_argument(
+        "--manifest",
+        "-m",
+        type=Path,
+        help="CSV file with one encoder,commit,preset baseline per line",
+    )
+    parser.add_argument(
+        "--latest",
+        action="store_true",
+        help="Use every preset of the latest commit of every encoder as a baseline",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="Compare the encodes of every commit in the results csv, not only those of the latest commit of every encoder",
+    )
+    parser.add_argument(
+        "--interp",
+        choices=bd_features.interpolations,
+        default="poly",
+        help="Curve fit, the global cubic polyfit or piecewise cubic pchip or akima interpolation",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of processes used to calculate BD rates",
+    )
+    parser.add_argument(
+        "--cache",
+        type=Path,
+        help="JSON file of previously calculated BD rates, only new or changed curves are calculated",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=4,
+        help="Number of threads used to read the folders and to upload batches",
+    )
+    parser.add_argument(
+        "--no-upload",
+        action="store_true",
+        help="Only calculate, do not connect to the database",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Load each batch with COPY into a staging table and merge it with one statement",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Fetch the keys of existing rows once per batch and check for duplicates in memory",
+    )
+    parser.add_argument(
+        "--ledger",
+        type=Path,
+        help="Log file of uploaded block hashes, unchanged blocks are skipped",
+    )
+    instrument.add_arguments(parser)
+    args = parser.parse_args()
+
+    instrument.start(args, args.bd_output or args.input / "pipeline")
+
+    baselines = list(args.baseline)
+    if args.manifest:
+        baselines.extend(bd_features.read_manifest(args.manifest))
+    baselines = list(dict.fromkeys(baselines))
+
+    if not (baselines or args.latest):
+        parser.error("a baseline is required, use --baseline, --manifest or --latest")
+
+    if args.index and not args.results_csv:
+        parser.error("--index needs --results-csv to keep the rows of files already read")
+
+    index_file = None
+    index = {}
+    if args.results_csv:
+        index_file = collect_stats.index_file(args.results_csv, args.index)
+        index = collect_stats.load_index(index_file, args.results_csv)
+
+    # Started before the upload threads, see process_pool
+    with process_pool(args.jobs) as processes:
+        if args.no_upload:
+            collected, ls = run(args, baselines, index, lambda rows, types: None, processes)
+            failed = 0
+        else:
+            import upload_metrics
+            from psycopg_pool import ConnectionPool
+
+            options = {
+                "bulk": args.bulk,
+                "prefetch": args.prefetch,
+                "ledger": upload_metrics.UploadLedger(args.ledger) if args.ledger else None,
+            }
+
+            with ConnectionPool(
+                upload_metrics.conninfo(), min_size=1, max_size=args.workers, open=True
+            ) as pool, ThreadPoolExecutor(max_workers=args.workers) as executor:
+                futures = []
+
+                # One batch per ledger block, so blocks hash the same as uploads
+                # of the results and bd_rates csv files
+                def submit(rows, types):
+                    for block in upload_metrics.block_hashes(rows, types).values():
+                        futures.append(
+                            executor.submit(_upload_batch, pool, block, types, options)
+                        )
+
+                collected, ls = run(args, baselines, index, submit, processes)
+                failed = sum(not x.result() for x in futures)
+
+            print(f"Uploaded {len(futures) - failed} of {len(futures)} batches")
+
+    with instrument.span("write"):
+        # Files of failed uploads are read and uploaded again on the next run
+        if index_file and not failed:
+            collect_stats.save_index(index_file, index)
+
+        if args.bd_output:
+            bd_features.write_output(args.bd_output, ls)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
 #!/usr/bin/env python3
-import psycopg, os, argparse, csv, traceback
+import psycopg, os, sys, argparse, csv, traceback, time, hashlib, json, threading
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
+from psycopg_pool import ConnectionPool
+
+import instrument
 
 load_dotenv(override=True)
 
@@ -38,15 +42,6 @@ cal_vmaf_5th = 11
 cal_ssim2_5th = 12
 
 
-def get_values_from_table(cur, table):
-    return statment_fetchall(cur, f"SELECT * FROM {table}")
-
-
-def statment_fetchall(cur, statement):
-    cur.execute(f"{statement}")
-    return cur.fetchall()
-
-
 def statment_fetchone(cur, statement):
     cur.execute(f"{statement}")
     return cur.fetchone()
@@ -56,162 +51,849 @@ def lookup_to_dictionary(lookup):
     return {row[1]: row[0] for row in lookup}
 
 
-def row_in_data(row, cur, encoders_lookup, videos_lookup, types):
-    if types == "calculations":
-        statement = f"""
-            SELECT * FROM calculations
-            WHERE
-                baseline_encoder_fkey = {encoders_lookup[row[cal_base_encoder]]}
-                AND baseline_encoder_commit = '{row[cal_base_commit]}'
-                AND baseline_encoder_preset = '{row[cal_base_preset]}'
-                AND target_encoder_fkey = {encoders_lookup[row[cal_tar_encoder]]}
-                AND target_encoder_commit = '{row[cal_tar_commit]}'
-                AND target_encoder_preset = '{row[cal_tar_preset]}'
-                AND video_fkey = {videos_lookup[row[cal_video]]}
+class CountingCursor(psycopg.Cursor):
+    """Cursor that counts the statements it sends, used while profiling."""
+
+    def execute(self, query, params=None, **kwargs):
+        instrument.count("statements")
+        return super().execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq, **kwargs):
+        params_seq = list(params_seq)
+        instrument.count("statements", len(params_seq))
+        return super().executemany(query, params_seq, **kwargs)
+
+    def copy(self, statement, params=None, **kwargs):
+        instrument.count("statements")
+        return super().copy(statement, params, **kwargs)
+
+
+def counted_cursor(conn):
+    """A cursor of conn, counting its statements while profiling."""
+    return CountingCursor(conn) if instrument.enabled else conn.cursor()
+
+
+# Columns that identify a row, enforced by the unique indexes of migrate_schema
+natural_keys = {
+    "results": ["encoder_fkey", "commit", "preset", "video_fkey", "quality"],
+    "calculations": [
+        "baseline_encoder_fkey",
+        "baseline_encoder_commit",
+        "baseline_encoder_preset",
+        "target_encoder_fkey",
+        "target_encoder_commit",
+        "target_encoder_preset",
+        "video_fkey",
+    ],
+    "encoders_lookup": ["name"],
+    "videos_lookup": ["name"],
+}
+
+# Foreign keys of every lookup table, used to merge duplicate names
+lookup_references = {
+    "encoders_lookup": [
+        ("results", "encoder_fkey"),
+        ("calculations", "baseline_encoder_fkey"),
+        ("calculations", "target_encoder_fkey"),
+    ],
+    "videos_lookup": [("results", "video_fkey"), ("calculations", "video_fkey")],
+}
+
+
+def natural_key_index(table):
+    return f"{table}_natural_key"
+
+
+def has_natural_key_index(cur, table):
+    """Whether migrate_schema created the unique index of table."""
+    cur.execute(
         """
+        SELECT EXISTS (
+            SELECT 1 FROM pg_indexes
+            WHERE schemaname = current_schema() AND tablename = %s AND indexname = %s
+        )
+        """,
+        (table, natural_key_index(table)),
+    )
+    return cur.fetchone()[0]
+
+
+def migrate_schema(conn):
+    """
+    Create unique indexes on the natural keys of every table so the database
+    rejects duplicates. Existing duplicates are removed first: duplicate lookup
+    names are merged into the lowest id and only the oldest row of every key is
+    kept in results and calculations.
+    """
+    with conn.cursor() as cur:
+        for table in natural_keys:
+            cur.execute(f"LOCK TABLE {table} IN SHARE ROW EXCLUSIVE MODE")
+
+        for lookup, references in lookup_references.items():
+            for table, column in references:
+                cur.execute(
+                    f"""
+                    UPDATE {table} t SET {column} = d.keep
+                    FROM (
+                        SELECT id, min(id) OVER (PARTITION BY name) AS keep FROM {lookup}
+                    ) d
+                    WHERE t.{column} = d.id AND d.id <> d.keep
+                    """
+                )
+            cur.execute(
+                f"""
+                DELETE FROM {lookup} l
+                WHERE l.id <> (SELECT min(m.id) FROM {lookup} m WHERE m.name = l.name)
+                """
+            )
+
+        for table in ["results", "calculations"]:
+            keys = ", ".join(natural_keys[table])
+            cur.execute(
+                f"""
+                DELETE FROM {table}
+                WHERE ctid IN (
+                    SELECT ctid FROM (
+                        SELECT
+                            ctid
+                            , row_number() OVER (PARTITION BY {keys} ORDER BY timestamp, ctid) AS n
+                        FROM {table}
+                    ) d
+                    WHERE d.n > 1
+                )
+                """
+            )
+            print(f"Removed {cur.rowcount} duplicate rows from {table}")
+
+        for table, columns in natural_keys.items():
+            cur.execute(
+                f"""
+                CREATE UNIQUE INDEX IF NOT EXISTS {natural_key_index(table)}
+                ON {table} ({", ".join(columns)})
+                """
+            )
+
+    conn.commit()
 
-        if statment_fetchone(cur, statement):
-            return True
+
+def row_key(row, encoders_lookup, videos_lookup, types):
+    """Natural key of a csv row, in the same form as the rows of fetch_keys."""
+    if types == "calculations":
+        return (
+            encoders_lookup[row[cal_base_encoder]],
+            row[cal_base_commit],
+            row[cal_base_preset],
+            encoders_lookup[row[cal_tar_encoder]],
+            row[cal_tar_commit],
+            row[cal_tar_preset],
+            videos_lookup[row[cal_video]],
+        )
     elif types == "results":
-        statement = f"""
-            SELECT * FROM results
-            WHERE
-                encoder_fkey = {encoders_lookup[row[res_encoder]]}
-                AND commit = '{row[res_commit]}'
-                AND preset = '{row[res_preset]}'
-                AND video_fkey = {videos_lookup[row[res_video]]}
-                AND quality = '{row[res_quality]}'
+        return (
+            encoders_lookup[row[res_encoder]],
+            row[res_commit],
+            row[res_preset],
+            videos_lookup[row[res_video]],
+            row[res_quality],
+        )
+
+
+def fetch_keys(cur, csv_data, types):
+    """
+    Natural keys of every row already in the database that could match a row
+    of csv_data, fetched with one query limited to the commits in the file.
+    """
+    if types == "calculations":
+        commits = list({row[cal_tar_commit] for row in csv_data})
+        statement = """
+            SELECT
+                baseline_encoder_fkey
+                , baseline_encoder_commit::text
+                , baseline_encoder_preset::text
+                , target_encoder_fkey
+                , target_encoder_commit::text
+                , target_encoder_preset::text
+                , video_fkey
+            FROM calculations
+            WHERE target_encoder_commit = ANY(%s)
+        """
+    elif types == "results":
+        commits = list({row[res_commit] for row in csv_data})
+        statement = """
+            SELECT
+                encoder_fkey
+                , commit::text
+                , preset::text
+                , video_fkey
+                , quality::text
+            FROM results
+            WHERE commit = ANY(%s)
         """
-        if statment_fetchone(cur, statement):
-            return True
 
-    return False
+    cur.execute(statement, (commits,))
+    return set(cur.fetchall())
 
 
-def add_to_lookup(cur, conn, record, lookup):
-    # Add video to videos lookup
-    cur.execute(f"INSERT INTO {lookup} (name) VALUES ('{record}')")
-    conn.commit()
-    lookup_values = lookup_to_dictionary(get_values_from_table(cur, lookup))
+def csv_names(csv_data, types):
+    """Distinct encoder and video names used by csv_data."""
+    if types == "calculations":
+        encoders = {row[cal_base_encoder] for row in csv_data}
+        encoders |= {row[cal_tar_encoder] for row in csv_data}
+        videos = {row[cal_video] for row in csv_data}
+    elif types == "results":
+        encoders = {row[res_encoder] for row in csv_data}
+        videos = {row[res_video] for row in csv_data}
 
-    return lookup_values
+    return sorted(encoders), sorted(videos)
 
 
-def calculations(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp):
-    for row in csv_data:
-        # Add baseline encoder to encoders lookup if it does not exist
-        if row[cal_base_encoder] not in encoders_lookup:
-            # Update encoders list
-            encoders_lookup = add_to_lookup(cur, conn, row[cal_base_encoder], "encoders_lookup")
-        
-        # Add target encoder to encoders lookup if it does not exist
-        if row[cal_tar_encoder] not in encoders_lookup:
-            # Update encoders list
-            encoders_lookup = add_to_lookup(cur, conn, row[cal_tar_encoder], "encoders_lookup")
-
-        # Add video to videos lookup if it does not exist
-        if row[cal_video] not in videos_lookup:
-            # Update videos list
-            videos_lookup = add_to_lookup(cur, conn, row[cal_video], "videos_lookup")
-
-        # If row is in the database skip
-        if row_in_data(row, cur, encoders_lookup, videos_lookup, "calculations"):
-            continue
-
-        # insert row into calculations table
+def lock_lookup(cur, lookup):
+    """
+    Serialize adding names to lookup until the end of the transaction, so
+    concurrent uploads can not add the same name twice.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (lookup,))
+
+
+def add_names_to_lookup(cur, names, lookup):
+    """
+    Add every name missing from lookup with one statement and return the ids
+    of all names, without committing so it is part of the upload transaction.
+    """
+    cur.execute(f"SELECT id, name FROM {lookup} WHERE name = ANY(%s)", (names,))
+    lookup_values = lookup_to_dictionary(cur.fetchall())
+
+    missing = [x for x in names if x not in lookup_values]
+    if missing:
+        lock_lookup(cur, lookup)
         cur.execute(
             f"""
-            INSERT INTO calculations (
-                timestamp
-                , baseline_encoder_fkey
-                , baseline_encoder_commit
-                , baseline_encoder_preset
-                , target_encoder_fkey
-                , target_encoder_commit
-                , target_encoder_preset
-                , video_fkey
-                , encode_time_pct
-                , decode_time_pct
-                , vmaf
-                , ssimulacra2
-                , vmaf_5th
-                , ssimulacra2_5th
-            ) VALUES (
-                '{timestamp}'
-                , {encoders_lookup[row[cal_base_encoder]]}
-                , '{row[cal_base_commit]}'
-                , '{row[cal_base_preset]}'
-                , {encoders_lookup[row[cal_tar_encoder]]}
-                , '{row[cal_tar_commit]}'
-                , '{row[cal_tar_preset]}'
-                , {videos_lookup[row[cal_video]]}
-                , '{row[cal_encode_time]}'
-                , '{row[cal_decode_time]}'
-                , '{row[cal_vmaf_mean]}'
-                , '{row[cal_ssim2_mean]}'
-                , '{row[cal_vmaf_5th]}'
-                , '{row[cal_ssim2_5th]}'
-            )"""
+            INSERT INTO {lookup} (name)
+            SELECT s.name FROM unnest(%s::text[]) AS s(name)
+            WHERE NOT EXISTS (SELECT 1 FROM {lookup} l WHERE l.name = s.name)
+            ON CONFLICT DO NOTHING
+            RETURNING id, name
+            """,
+            (missing,),
         )
-    
+        lookup_values.update(lookup_to_dictionary(cur.fetchall()))
+
+        # Names added by another upload while waiting for the lock
+        added = [x for x in missing if x not in lookup_values]
+        if added:
+            cur.execute(f"SELECT id, name FROM {lookup} WHERE name = ANY(%s)", (added,))
+            lookup_values.update(lookup_to_dictionary(cur.fetchall()))
+
+    return lookup_values
+
+
+calculations_insert = """
+    INSERT INTO calculations (
+        timestamp
+        , baseline_encoder_fkey
+        , baseline_encoder_commit
+        , baseline_encoder_preset
+        , target_encoder_fkey
+        , target_encoder_commit
+        , target_encoder_preset
+        , video_fkey
+        , encode_time_pct
+        , decode_time_pct
+        , vmaf
+        , ssimulacra2
+        , vmaf_5th
+        , ssimulacra2_5th
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT DO NOTHING
+"""
+
+results_insert = """
+    INSERT INTO results (
+        timestamp
+        , encoder_fkey
+        , commit
+        , preset
+        , video_fkey
+        , size
+        , quality
+        , bitrate
+        , first_encode_time
+        , second_encode_time
+        , decode_time
+        , vmaf
+        , ssimulacra2
+        , vmaf_5th
+        , ssimulacra2_5th
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT DO NOTHING
+"""
+
+
+def calculations(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp, keys=None):
+    params = []
+    for row in csv_data:
+        # Without keys duplicates are rejected by the unique index
+        if keys is not None:
+            key = row_key(row, encoders_lookup, videos_lookup, "calculations")
+            if key in keys:
+                continue
+            keys.add(key)
+
+        params.append(
+            (
+                timestamp,
+                encoders_lookup[row[cal_base_encoder]],
+                row[cal_base_commit],
+                row[cal_base_preset],
+                encoders_lookup[row[cal_tar_encoder]],
+                row[cal_tar_commit],
+                row[cal_tar_preset],
+                videos_lookup[row[cal_video]],
+                row[cal_encode_time],
+                row[cal_decode_time],
+                row[cal_vmaf_mean],
+                row[cal_ssim2_mean],
+                row[cal_vmaf_5th],
+                row[cal_ssim2_5th],
+            )
+        )
+
+    # The statement is prepared once and sent for every row in a pipeline
+    # without waiting for each result
+    with instrument.span("insert"), conn.pipeline():
+        cur.executemany(calculations_insert, params)
+    inserted = cur.rowcount
+
     conn.commit()
+    return inserted
 
 
-def results(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp):
+def results(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp, keys=None):
+    params = []
     for row in csv_data:
-        # Add encoder to encoders lookup if it does not exist
-        if row[res_encoder] not in encoders_lookup:
-            # Update encoders list
-            encoders_lookup = add_to_lookup(cur, conn, row[res_encoder], "encoders_lookup")
-        
-        # Add video to videos lookup if it does not exist
-        if row[res_video] not in videos_lookup:
-            # Update videos list
-            videos_lookup = add_to_lookup(cur, conn, row[res_video], "videos_lookup")
-
-        # If row is in the database skip
-        if row_in_data(row, cur, encoders_lookup, videos_lookup, "results"):
-            continue
-
-        # insert row into calculations table
-        cur.execute(
-            f"""
-            INSERT INTO results (
-                timestamp
-                , encoder_fkey
-                , commit
-                , preset
-                , video_fkey
-                , size
-                , quality
-                , bitrate
-                , first_encode_time
-                , second_encode_time
-                , decode_time
-                , vmaf
-                , ssimulacra2
-                , vmaf_5th
-                , ssimulacra2_5th
-            ) VALUES (
-                '{timestamp}'
-                , {encoders_lookup[row[res_encoder]]}
-                , '{row[res_commit]}'
-                , '{row[res_preset]}'
-                , {videos_lookup[row[res_video]]}
-                , '{row[res_size]}'
-                , '{row[res_quality]}'
-                , '{row[res_bitrate]}'
-                , '{row[res_1_encode_time]}'
-                , '{row[res_2_encode_time]}'
-                , '{row[res_decode_time]}'
-                , '{row[res_vmaf_mean]}'
-                , '{row[res_ssim2_mean]}'
-                , '{row[res_vmaf_5th]}'
-                , '{row[res_ssim2_5th]}'
-            )"""
+        # Without keys duplicates are rejected by the unique index
+        if keys is not None:
+            key = row_key(row, encoders_lookup, videos_lookup, "results")
+            if key in keys:
+                continue
+            keys.add(key)
+
+        params.append(
+            (
+                timestamp,
+                encoders_lookup[row[res_encoder]],
+                row[res_commit],
+                row[res_preset],
+                videos_lookup[row[res_video]],
+                row[res_size],
+                row[res_quality],
+                row[res_bitrate],
+                row[res_1_encode_time],
+                row[res_2_encode_time],
+                row[res_decode_time],
+                row[res_vmaf_mean],
+                row[res_ssim2_mean],
+                row[res_vmaf_5th],
+                row[res_ssim2_5th],
+            )
+        )
+
+    # The statement is prepared once and sent for every row in a pipeline
+    # without waiting for each result
+    with instrument.span("insert"), conn.pipeline():
+        cur.executemany(results_insert, params)
+    inserted = cur.rowcount
+
+    conn.commit()
+    return inserted
+
+
+# Staging columns in CSV order, encoders and videos are names instead of keys
+results_staging_columns = [
+    "encoder",
+    "commit",
+    "preset",
+    "video",
+    "size",
+    "quality",
+    "bitrate",
+    "first_encode_time",
+    "second_encode_time",
+    "decode_time",
+    "vmaf",
+    "ssimulacra2",
+    "vmaf_5th",
+    "ssimulacra2_5th",
+]
+
+calculations_staging_columns = [
+    "baseline_encoder",
+    "baseline_encoder_commit",
+    "baseline_encoder_preset",
+    "target_encoder",
+    "target_encoder_commit",
+    "target_encoder_preset",
+    "video",
+    "encode_time_pct",
+    "decode_time_pct",
+    "vmaf",
+    "ssimulacra2",
+    "vmaf_5th",
+    "ssimulacra2_5th",
+]
+
+name_columns = ["encoder", "video", "baseline_encoder", "target_encoder"]
+
+
+def copy_to_staging(cur, table, columns, csv_data):
+    """
+    Stream csv_data into a temporary staging table with COPY. The staging
+    table takes its column types from table so COPY converts the values, name
+    columns are text and line keeps the order of the csv.
+    """
+    staging = f"{table}_staging"
+    select = ", ".join(
+        [f"NULL::text AS {x}" if x in name_columns else x for x in columns]
+    )
+
+    cur.execute(
+        f"""
+        CREATE TEMP TABLE {staging} ON COMMIT DROP AS
+        SELECT NULL::bigint AS line, {select} FROM {table}
+        WITH NO DATA
+        """
+    )
+
+    with cur.copy(f"COPY {staging} (line, {', '.join(columns)}) FROM STDIN") as copy:
+        for line, row in enumerate(csv_data):
+            copy.write_row([line] + row[: len(columns)])
+
+    return staging
+
+
+def bulk_add_to_lookup(cur, staging, columns, lookup):
+    """Add every name of columns in staging that is not already in lookup."""
+    names = " UNION ".join([f"SELECT {x} AS name FROM {staging}" for x in columns])
+    missing = f"""
+        SELECT DISTINCT s.name FROM ({names}) s
+        WHERE NOT EXISTS (SELECT 1 FROM {lookup} l WHERE l.name = s.name)
+    """
+
+    if not statment_fetchone(cur, f"SELECT EXISTS ({missing})")[0]:
+        return
+
+    lock_lookup(cur, lookup)
+    cur.execute(f"INSERT INTO {lookup} (name) {missing}")
+
+
+def bulk_calculations(cur, conn, csv_data, timestamp):
+    with instrument.span("copy"):
+        staging = copy_to_staging(cur, "calculations", calculations_staging_columns, csv_data)
+
+    bulk_add_to_lookup(cur, staging, ["baseline_encoder", "target_encoder"], "encoders_lookup")
+    bulk_add_to_lookup(cur, staging, ["video"], "videos_lookup")
+
+    # Insert every row that is not already in the database, the first
+    # occurrence wins when the csv itself has duplicates
+    cur.execute(
+        f"""
+        INSERT INTO calculations (
+            timestamp
+            , baseline_encoder_fkey
+            , baseline_encoder_commit
+            , baseline_encoder_preset
+            , target_encoder_fkey
+            , target_encoder_commit
+            , target_encoder_preset
+            , video_fkey
+            , encode_time_pct
+            , decode_time_pct
+            , vmaf
+            , ssimulacra2
+            , vmaf_5th
+            , ssimulacra2_5th
+        )
+        SELECT DISTINCT ON (
+            b.id
+            , s.baseline_encoder_commit
+            , s.baseline_encoder_preset
+            , t.id
+            , s.target_encoder_commit
+            , s.target_encoder_preset
+            , v.id
+        )
+            %(timestamp)s
+            , b.id
+            , s.baseline_encoder_commit
+            , s.baseline_encoder_preset
+            , t.id
+            , s.target_encoder_commit
+            , s.target_encoder_preset
+            , v.id
+            , s.encode_time_pct
+            , s.decode_time_pct
+            , s.vmaf
+            , s.ssimulacra2
+            , s.vmaf_5th
+            , s.ssimulacra2_5th
+        FROM {staging} s
+        JOIN encoders_lookup b ON b.name = s.baseline_encoder
+        JOIN encoders_lookup t ON t.name = s.target_encoder
+        JOIN videos_lookup v ON v.name = s.video
+        WHERE NOT EXISTS (
+            SELECT 1 FROM calculations c
+            WHERE
+                c.baseline_encoder_fkey = b.id
+                AND c.baseline_encoder_commit = s.baseline_encoder_commit
+                AND c.baseline_encoder_preset = s.baseline_encoder_preset
+                AND c.target_encoder_fkey = t.id
+                AND c.target_encoder_commit = s.target_encoder_commit
+                AND c.target_encoder_preset = s.target_encoder_preset
+                AND c.video_fkey = v.id
         )
-    
+        ORDER BY
+            b.id
+            , s.baseline_encoder_commit
+            , s.baseline_encoder_preset
+            , t.id
+            , s.target_encoder_commit
+            , s.target_encoder_preset
+            , v.id
+            , s.line
+        ON CONFLICT DO NOTHING
+        """,
+        {"timestamp": timestamp},
+    )
+    inserted = cur.rowcount
+
+    conn.commit()
+    return inserted
+
+
+def bulk_results(cur, conn, csv_data, timestamp):
+    with instrument.span("copy"):
+        staging = copy_to_staging(cur, "results", results_staging_columns, csv_data)
+
+    bulk_add_to_lookup(cur, staging, ["encoder"], "encoders_lookup")
+    bulk_add_to_lookup(cur, staging, ["video"], "videos_lookup")
+
+    # Insert every row that is not already in the database, the first
+    # occurrence wins when the csv itself has duplicates
+    cur.execute(
+        f"""
+        INSERT INTO results (
+            timestamp
+            , encoder_fkey
+            , commit
+            , preset
+            , video_fkey
+            , size
+            , quality
+            , bitrate
+            , first_encode_time
+            , second_encode_time
+            , decode_time
+            , vmaf
+            , ssimulacra2
+            , vmaf_5th
+            , ssimulacra2_5th
+        )
+        SELECT DISTINCT ON (e.id, s.commit, s.preset, v.id, s.quality)
+            %(timestamp)s
+            , e.id
+            , s.commit
+            , s.preset
+            , v.id
+            , s.size
+            , s.quality
+            , s.bitrate
+            , s.first_encode_time
+            , s.second_encode_time
+            , s.decode_time
+            , s.vmaf
+            , s.ssimulacra2
+            , s.vmaf_5th
+            , s.ssimulacra2_5th
+        FROM {staging} s
+        JOIN encoders_lookup e ON e.name = s.encoder
+        JOIN videos_lookup v ON v.name = s.video
+        WHERE NOT EXISTS (
+            SELECT 1 FROM results r
+            WHERE
+                r.encoder_fkey = e.id
+                AND r.commit = s.commit
+                AND r.preset = s.preset
+                AND r.video_fkey = v.id
+                AND r.quality = s.quality
+        )
+        ORDER BY e.id, s.commit, s.preset, v.id, s.quality, s.line
+        ON CONFLICT DO NOTHING
+        """,
+        {"timestamp": timestamp},
+    )
+    inserted = cur.rowcount
+
     conn.commit()
+    return inserted
+
+
+def conninfo():
+    return f"dbname={os.getenv('DBNAME')} user={os.getenv('USER')} password={os.getenv('PASSWORD')} host={os.getenv('HOST')} port={os.getenv('PORT')}"
+
+
+def block_key(row, types):
+    """Rows are tracked in the ledger in blocks of one encoder and commit."""
+    if types == "calculations":
+        return (row[cal_base_encoder], row[cal_base_commit], row[cal_tar_encoder], row[cal_tar_commit])
+    elif types == "results":
+        return (row[res_encoder], row[res_commit])
+
+
+def block_hashes(csv_data, types):
+    """Content hash of every block of csv_data, mapped to the rows of the block."""
+    blocks = {}
+    for row in csv_data:
+        blocks.setdefault(block_key(row, types), []).append(row)
+
+    # Rows are sorted so a block hashes the same whatever order it was built in
+    hashes = {}
+    for key, rows in blocks.items():
+        content = "\n".join([types, *key] + sorted(",".join(x) for x in rows))
+        hashes[hashlib.sha1(content.encode()).hexdigest()] = rows
+
+    return hashes
+
+
+class UploadLedger:
+    """
+    Content hashes of files and row blocks that were already uploaded, one a
+    line in a log file that new hashes are appended to. Shared by the upload
+    threads, entries are only added after the upload transaction is committed.
+    The log is compacted when it is loaded.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+        self.hashes = set()
+        if file.exists():
+            with open(file) as f:
+                text = f.read()
+
+            # Ledgers used to be written as one json list
+            lines = json.loads(text) if text.startswith("[") else text.split()
+            self.hashes = set(lines)
+
+            if len(lines) != len(self.hashes) or text.startswith("["):
+                temp = file.with_name(file.name + ".tmp")
+                with open(temp, "w") as f:
+                    f.writelines(f"{x}\n" for x in sorted(self.hashes))
+                temp.replace(file)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.hashes
+
+    def add(self, hashes):
+        with self.lock:
+            new = set(hashes) - self.hashes
+            if new:
+                self.hashes.update(new)
+                with open(self.file, "a") as f:
+                    f.writelines(f"{x}\n" for x in sorted(new))
+
+
+def upload_rows(conn, csv_data, types, mtime=None, bulk=False, prefetch=False, ledger=None):
+    """
+    Upload rows of the given type in their own transaction, timestamped with
+    the epoch time mtime or the current time. With a ledger, blocks of rows that
+    were uploaded before are skipped without sending anything to the database.
+    """
+    hashes = {}
+    if ledger is not None:
+        hashes = block_hashes(csv_data, types)
+        hashes = {key: rows for key, rows in hashes.items() if key not in ledger}
+        instrument.count(
+            "rows_skipped_ledger", len(csv_data) - sum(len(x) for x in hashes.values())
+        )
+        csv_data = [row for rows in hashes.values() for row in rows]
+
+    if csv_data:
+        with instrument.span(types), counted_cursor(conn) as cur:
+
+            if mtime is None:
+                cur.execute("SELECT now()")
+            else:
+                # Convert epoch time to postgres timestamp with mst timezone
+                cur.execute("SELECT to_timestamp(%s)", (mtime,))
+            timestamp = cur.fetchone()[0]
+
+            # Every encoder and video of the rows is added up front so the
+            # per row inserts never touch the lookup tables
+            if not bulk:
+                with instrument.span("lookups"):
+                    encoders, videos = csv_names(csv_data, types)
+                    encoders_lookup = add_names_to_lookup(cur, encoders, "encoders_lookup")
+                    videos_lookup = add_names_to_lookup(cur, videos, "videos_lookup")
+
+            # Duplicates are checked in memory when asked for or when the
+            # database can not reject them itself
+            keys = None
+            if not bulk and (prefetch or not has_natural_key_index(cur, types)):
+                with instrument.span("fetch_keys"):
+                    keys = fetch_keys(cur, csv_data, types)
+
+            if bulk and types == "calculations":
+                with instrument.span("bulk"):
+                    inserted = bulk_calculations(cur, conn, csv_data, timestamp)
+            elif bulk and types == "results":
+                with instrument.span("bulk"):
+                    inserted = bulk_results(cur, conn, csv_data, timestamp)
+            elif types == "calculations":
+                inserted = calculations(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp, keys)
+            elif types == "results":
+                inserted = results(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp, keys)
+            else:
+                raise Exception("Invalid type argument")
+
+            instrument.count("rows_inserted", inserted)
+            instrument.count("rows_skipped", len(csv_data) - inserted)
+
+    if ledger is not None and hashes:
+        ledger.add(hashes)
+
+
+def upload_file(conn, file, types, bulk=False, prefetch=False, header=True, ledger=None):
+    """
+    Upload one csv file of the given type in its own transaction. With a ledger,
+    files that were uploaded before are skipped without reading their rows.
+    """
+    with open(file, "rb") as f:
+        file_hash = hashlib.sha1(f.read()).hexdigest()
+
+    if ledger is not None and file_hash in ledger:
+        print(f"Skipping {file}, already uploaded")
+        instrument.count("files_skipped_ledger")
+        return
+
+    with instrument.span("read_csv"), open(file) as csvfile:
+        reader = csv.reader(csvfile, delimiter=",")
+        # Skip headers
+        if header:
+            next(reader)
+
+        csv_data = [row for row in reader if row]
+    instrument.count("rows_parsed", len(csv_data))
+
+    upload_rows(
+        conn, csv_data, types, os.path.getmtime(file), bulk, prefetch, ledger
+    )
+
+    if ledger is not None:
+        ledger.add([file_hash])
+
+
+def _pooled_upload(pool, file, types, header, options):
+    try:
+        with pool.connection() as conn:
+            upload_file(conn, file, types, header=header, **options)
+        print(f"Uploaded {file}")
+        return True
+    except Exception as err:
+        print(f"Failed to upload {file}: {err=}, {type(err)=}")
+        print(traceback.format_exc())
+        return False
+
+
+def upload_files(pool, files, workers, **options):
+    """
+    Upload (type, file) pairs concurrently over a connection pool, each file in
+    its own transaction. options are passed on to upload_file. Returns the
+    files that failed.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_pooled_upload, pool, file, types, True, options): file
+            for types, file in files
+        }
+        return [file for future, file in futures.items() if not future.result()]
+
+
+def watched_file_type(file):
+    """Type and whether there is a header for files picked up by watch."""
+    if file.suffix == ".stats":
+        return "results", False
+    if file.name.endswith("_bd_rates.csv"):
+        return "calculations", True
+    return None, None
+
+
+def stats_complete(file):
+    """A .stats file only has all of its columns once the metrics are added."""
+    with open(file) as f:
+        row = next(csv.reader(f, delimiter=","), [])
+    return len(row) > res_ssim2_5th
+
+
+def watch(pool, directory, workers, interval, **options):
+    """
+    Poll directory for new or changed .stats and *_bd_rates.csv files and upload
+    them. A file is uploaded once its modification time and size are the same
+    on two scans in a row, so files that are still being written are skipped.
+    Files whose upload failed are tried again on later scans.
+    """
+    uploaded = {}
+    uploading = {}
+    pending = {}
+
+    # Runs on the upload thread, a version only counts as uploaded once its
+    # transaction is committed
+    def done(future, file, version):
+        if uploading.get(file) == version:
+            del uploading[file]
+        if future.result():
+            uploaded[file] = version
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for file in directory.rglob("*"):
+                types, header = watched_file_type(file)
+                if types is None or not file.is_file():
+                    continue
+
+                stat = file.stat()
+                version = (stat.st_mtime, stat.st_size)
+                if version in (uploaded.get(file), uploading.get(file)):
+                    continue
+
+                if pending.get(file) != version:
+                    pending[file] = version
+                    continue
+
+                del pending[file]
+                if types == "results" and not stats_complete(file):
+                    continue
+
+                uploading[file] = version
+                future = executor.submit(
+                    _pooled_upload, pool, file, types, header, options
+                )
+                future.add_done_callback(
+                    lambda x, file=file, version=version: done(x, file, version)
+                )
+
+            time.sleep(interval)
+
+
+def parse_file(value):
+    """argparse type for a file given as type:path."""
+    types, _, file = value.partition(":")
+    if types not in ["calculations", "results"] or not file:
+        raise argparse.ArgumentTypeError(
+            f"{value} is not in the form calculations:path or results:path"
+        )
+
+    return types, Path(file)
 
 
 def main():
@@ -224,37 +906,93 @@ def main():
         choices=["calculations", "results"],
         help="calculations for bd_rate files, results for result csv files",
     )
+    parser.add_argument(
+        "--file",
+        "-f",
+        type=parse_file,
+        action="append",
+        default=[],
+        help="File to upload as type:path, can be repeated to upload many files concurrently",
+    )
+    parser.add_argument(
+        "--watch",
+        "-w",
+        type=Path,
+        help="Keep running and upload new .stats and *_bd_rates.csv files in this folder",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=10,
+        help="Seconds between scans of the watched folder",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of files uploaded at the same time",
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Load the file with COPY into a staging table and merge it with one statement",
+    )
+    parser.add_argument(
+        "--prefetch",
+        action="store_true",
+        help="Fetch the keys of existing rows once and check for duplicates in memory",
+    )
+    parser.add_argument(
+        "--migrate",
+        action="store_true",
+        help="Remove duplicate rows and create unique indexes on the natural keys",
+    )
+    parser.add_argument(
+        "--ledger",
+        type=Path,
+        help="Log file of uploaded file and block hashes, unchanged data is skipped",
+    )
+    instrument.add_arguments(parser)
     args = parser.parse_args()
 
-    try:
-        with psycopg.connect(
-            f"dbname={os.getenv('DBNAME')} user={os.getenv('USER')} password={os.getenv('PASSWORD')} host={os.getenv('HOST')} port={os.getenv('PORT')}"
-        ) as conn:
-
-            with conn.cursor() as cur:
+    # The report goes next to the first file uploaded
+    first = args.input or next((x[1] for x in args.file), None) or args.watch or "upload_metrics"
+    instrument.start(args, first)
+
+    if args.migrate:
+        with instrument.span("migrate"), psycopg.connect(conninfo()) as conn:
+            migrate_schema(conn)
+        if not (args.input or args.file or args.watch):
+            return
+
+    options = {
+        "bulk": args.bulk,
+        "prefetch": args.prefetch,
+        "ledger": UploadLedger(args.ledger) if args.ledger else None,
+    }
+
+    if args.file or args.watch:
+        files = list(args.file)
+        if args.input:
+            files.append((args.type, args.input))
+
+        with ConnectionPool(
+            conninfo(), min_size=1, max_size=args.workers, open=True
+        ) as pool:
+            failed = upload_files(pool, files, args.workers, **options)
+            for file in failed:
+                print(f"Failed: {file}")
+
+            if args.watch:
+                watch(pool, args.watch, args.workers, args.interval, **options)
+
+        if failed:
+            sys.exit(1)
+        return
 
-                encoders_lookup = lookup_to_dictionary(get_values_from_table(cur, "encoders_lookup"))
-                videos_lookup = lookup_to_dictionary(get_values_from_table(cur, "videos_lookup"))
-
-                # Convert epoch time to postgres timestamp with mst timezone
-                timestamp_statement = f"to_timestamp({os.path.getmtime(args.input)})"
-
-                # get timestamp from database
-                timestamp = statment_fetchall(cur, f"SELECT {timestamp_statement}")[0][0]
-
-                with open(args.input) as csvfile:
-                    reader = csv.reader(csvfile, delimiter=",")
-                    # Skip headers
-                    next(reader)
-
-                    csv_data = [row for row in reader]
-
-                    if args.type == "calculations":
-                        calculations(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp)
-                    elif args.type == "results":
-                        results(cur, conn, csv_data, encoders_lookup, videos_lookup, timestamp)
-                    else:
-                        raise Exception("Invalid type argument")
+    try:
+        with psycopg.connect(conninfo()) as conn:
+            upload_file(conn, args.input, args.type, **options)
     except Exception as err:
         print(f"Unexpected {err=}, {type(err)=}")
         print(traceback.format_exc())
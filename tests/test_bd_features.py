@@ -0,0 +1,146 @@
+import sys, warnings
+
+import numpy as np
+import pytest
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+import bd_features
+import collect_stats
+
+
+def pad(values, n_points):
+    return np.concatenate([values, np.full(n_points - len(values), np.nan)])[None]
+
+
+def test_bdrate_batch_three_point_curve():
+    baseline = [(500.0, 70.1), (1100.0, 78.4), (2300.0, 84.9), (4100.0, 89.2), (7000.0, 92.3), (9800.0, 94.0)]
+    target = [(650.0, 72.3), (1900.0, 83.0), (5200.0, 90.8)]
+
+    # polyfit warns that a cubic through 3 points is poorly conditioned
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        expected = bd_features.bdrate(baseline, target)
+        result = bd_features.bdrate_batch(
+            pad([x[0] for x in baseline], 6),
+            pad([x[1] for x in baseline], 6)[None],
+            pad([x[0] for x in target], 6),
+            pad([x[1] for x in target], 6)[None],
+        )
+
+    assert np.isclose(result[0, 0], expected, rtol=1e-9, atol=1e-9)
+
+
+def test_load_results_header_only(tmp_path):
+    file = tmp_path / "results.csv"
+    file.write_text(",".join(collect_stats.header) + "\n")
+
+    results = bd_features.load_results(file)
+    groups = bd_features.group_rows(results)
+
+    assert len(results) == 0
+    assert bd_features.compare_baselines(results, groups, [("svt", "abc", "4")]) == []
+
+
+@pytest.mark.parametrize("n_frames", [1, 2, 7, 500])
+def test_resampled_statistics_match_numpy(n_frames):
+    rng = np.random.default_rng(n_frames)
+    # Rounded so some frames share a score
+    scores = np.round(rng.uniform(20, 100, n_frames), 1)
+    counts = rng.multinomial(n_frames, np.full(n_frames, 1 / n_frames), size=50)
+    # A resample of only the best frames never reaches the low percentile
+    # within the frames searched first
+    counts[0] = 0
+    counts[0, np.argmax(scores)] = n_frames
+
+    result = bd_features.resampled_statistics(scores, counts)
+
+    for column, statistic in zip(bd_features.bootstrap_columns.values(), result):
+        for row, value in zip(counts, statistic):
+            frames = np.repeat(scores, row)
+            expected = frames.mean() if column is None else np.percentile(frames, column)
+            assert np.isclose(value, expected, rtol=1e-12, atol=1e-12)
+
+
+def scipy_bdrate(baseline, target, interpolator):
+    """bdrate with log rate over metric interpolated by a SciPy interpolator."""
+    fits = []
+    for points in [baseline, target]:
+        points = sorted(points, key=lambda x: x[1])
+        fits.append(interpolator([x[1] for x in points], np.log([x[0] for x in points])))
+
+    lower = max(min(x[1] for x in baseline), min(x[1] for x in target))
+    upper = min(max(x[1] for x in baseline), max(x[1] for x in target))
+    diff = fits[1].integrate(lower, upper) - fits[0].integrate(lower, upper)
+
+    return (np.exp(diff / (upper - lower)) - 1) * 100
+
+
+@pytest.mark.parametrize("interp", ["pchip", "akima"])
+def test_bdrate_batch_piecewise_matches_scipy(interp):
+    interpolate = pytest.importorskip("scipy.interpolate")
+    interpolator = {
+        "pchip": interpolate.PchipInterpolator,
+        "akima": interpolate.Akima1DInterpolator,
+    }[interp]
+
+    baseline = [(500.0, 70.1), (1100.0, 78.4), (2300.0, 84.9), (4100.0, 89.2), (7000.0, 92.3), (9800.0, 94.0)]
+    targets = [
+        [(450.0, 71.0), (980.0, 79.2), (2100.0, 85.3), (3900.0, 89.9), (6400.0, 92.6), (9000.0, 94.1)],
+        # Flat and steep stretches exercise the derivative limits
+        [(600.0, 69.0), (1300.0, 80.5), (2000.0, 80.7), (5200.0, 91.0), (8800.0, 91.1)],
+    ]
+
+    for target in targets:
+        expected = scipy_bdrate(baseline, target, interpolator)
+        result = bd_features.bdrate_batch(
+            pad([x[0] for x in baseline], 6),
+            pad([x[1] for x in baseline], 6)[None],
+            pad([x[0] for x in target], 6),
+            pad([x[1] for x in target], 6)[None],
+            interp,
+        )
+
+        assert np.isclose(result[0, 0], expected, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize("interp", ["pchip", "akima"])
+def test_bdrate_batch_piecewise_without_overlap(interp):
+    baseline = [(500.0, 60.0), (1100.0, 65.0), (2300.0, 70.0), (4100.0, 74.0)]
+    target = [(800.0, 80.0), (1500.0, 85.0), (3000.0, 90.0), (6000.0, 94.0)]
+
+    result = bd_features.bdrate_batch(
+        pad([x[0] for x in baseline], 4),
+        pad([x[1] for x in baseline], 4)[None],
+        pad([x[0] for x in target], 4),
+        pad([x[1] for x in target], 4)[None],
+        interp,
+    )
+
+    assert np.isnan(result[0, 0])
+
+
+def run_main(monkeypatch, *argv):
+    monkeypatch.setattr(sys, "argv", ["bd_features.py", *map(str, argv)])
+    bd_features.main()
+
+
+@pytest.mark.parametrize("extra", [[], ["--interp", "akima"]])
+def test_shards_merge_to_unsharded_output(tmp_path, monkeypatch, extra):
+    import benchmark
+
+    results = tmp_path / "results.csv"
+    benchmark.generate_results(results, 2, 3, 3, 4, 5)
+
+    run_main(monkeypatch, "-i", results, "--latest", "-o", tmp_path / "full.csv", *extra)
+
+    partials = []
+    for i in range(3):
+        partials.append(tmp_path / f"part_{i}.json")
+        run_main(monkeypatch, "-i", results, "--latest", "--shard", f"{i}/3", "-o", partials[-1], *extra)
+
+    run_main(monkeypatch, "merge", *partials, "-o", tmp_path / "merged.csv")
+
+    assert (tmp_path / "merged.csv").read_bytes() == (tmp_path / "full.csv").read_bytes()
@@ -0,0 +1,34 @@
+import io, json, sys
+
+import pytest
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "scripts"))
+
+import parse_vmaf
+
+
+document = {
+    "version": "2.3.1 \"release\", 0123456789",
+    "frames": [
+        {"frameNum": i, "metrics": {"vmaf": 100 - i * 7.123456789, "integer_adm2": 0.987654321e-3}}
+        for i in range(12)
+    ],
+    "pooled_metrics": {"vmaf": {"min": -12.5, "mean": 61.2345678, "harmonic_mean": 55.0}},
+    "aggregate_metrics": {},
+    "count": 1234567890123,
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 1 << 16])
+def test_json_stream_values_split_across_chunks(chunk_size):
+    text = json.dumps(document, indent=2)
+    stream = parse_vmaf.JSONStream(io.StringIO(text), chunk_size=chunk_size)
+
+    result = {}
+    for key in stream.items():
+        result[key] = list(stream.array()) if key == "frames" else stream.value()
+
+    assert stream.peek() == ""
+    assert result == json.loads(text)